@@ -0,0 +1,226 @@
+"""
+Time the credit, leader board and persistence paths on synthetic servers, without connecting to discord
+
+Run from the src folder:
+    python benchmark.py                 Compare against the saved baseline
+    python benchmark.py --save          Save the results as the new baseline
+    python benchmark.py --sizes 1000    Only benchmark a server of 1,000 members
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+
+from dotenv import load_dotenv
+from fake_discord import FakeMember, FakeRole, FakeGuild, FakeChannel, FakeMessage, temporary_data_directory
+
+load_dotenv()
+
+
+class DiscardQueue:
+    """
+    Outbound queue that drops every reply, so only the work of building them is timed
+    """
+
+    def send(self, channel: object, content: str = None, file: object = None):
+        """
+        Drop the reply
+
+        :param channel: Discord channel the reply was for
+        :param content: Text of the reply
+        :param file: Discord file attached to the reply
+        """
+
+
+class Benchmark:
+    """
+    Time the hot paths of the bot on synthetic servers of each size
+    """
+
+    def __init__(self, sizes: list, repeat: int, role_size: int):
+        """
+        Time the hot paths of the bot on synthetic servers of each size
+
+        :param sizes: Number of members of each server to benchmark
+        :param repeat: Times to run each benchmark, the minimum and median are kept
+        :param role_size: Most members of the role mentioned by the add benchmark
+        """
+        self.sizes = sizes
+        self.repeat = repeat
+        self.role_size = role_size
+        self.results = {}
+        self.fresh_guilds = 0
+        self.bot = None
+        self.loop = None
+
+    def run(self) -> dict:
+        """
+        Run every benchmark in a temporary copy of the data folder, so the real credits are never touched
+
+        :return: Dictionary of the milliseconds each benchmark took by server size and name
+        """
+        with temporary_data_directory():
+            from social_credit_bot import DiscordBot
+            self.bot = DiscordBot(start=False)
+            self.loop = asyncio.get_event_loop()
+            for size in self.sizes:
+                self.benchmark_size(size)
+            self.bot.guild_states.close()
+        return self.results
+
+    def measure(self, size: int, name: str, function, setup=None):
+        """
+        Time the function, keeping the minimum and median of the repeats
+
+        :param size: Number of members of the server being benchmarked
+        :param name: Name of the benchmark
+        :param function: Function to time, called with whatever setup returns
+        :param setup: Untimed function run before each repeat
+        """
+        samples = []
+        for _ in range(self.repeat):
+            argument = setup() if setup is not None else None
+            start_time = time.perf_counter()
+            function(argument)
+            samples.append(time.perf_counter() - start_time)
+        self.results.setdefault(str(size), {})[name] = {'min': min(samples) * 1000,
+                                                        'median': statistics.median(samples) * 1000}
+        print(f'{size:>8,} {name:<32}{min(samples) * 1000:>12.2f}{statistics.median(samples) * 1000:>12.2f}')
+
+    def handle(self, guild: FakeGuild, content: str, mentions: list = (), role_mentions: list = ()):
+        """
+        Handle a command the way on_message does, without the throttle
+
+        :param guild: Server the command is sent in
+        :param content: Text of the message
+        :param mentions: Members mentioned in the message
+        :param role_mentions: Roles mentioned in the message
+        """
+        from command_context import CommandContext
+
+        message = FakeMessage(content, guild, guild.members[0], FakeChannel(1), mentions, role_mentions)
+        command = self.bot.command_router.parse(content)
+        guild_state = self.bot.guild_states.get(guild.id)
+        context = CommandContext(message, command, guild_state, DiscardQueue())
+        self.loop.run_until_complete(self.bot.command_groups[command.group](context))
+
+    def fresh_guild(self, size: int) -> FakeGuild:
+        """
+        Create a server the bot has never seen
+
+        :param size: Number of members of the server
+        :return: New server
+        """
+        self.fresh_guilds += 1
+        return FakeGuild(size * 1000 + self.fresh_guilds, [FakeMember(user_id) for user_id in range(1, size + 1)])
+
+    def benchmark_size(self, size: int):
+        """
+        Run every benchmark on a server of the given size
+
+        :param size: Number of members of the server
+        """
+        from guild_state import GuildState
+
+        self.fresh_guilds = 0
+        guild = self.fresh_guild(size)
+
+        # Members are only new the first time a server is synced, so each repeat gets a server of its own
+        def sync_new_members(new_guild):
+            self.bot.get_all_member_credit_information(new_guild)
+            self.bot.guild_states.guilds.pop(new_guild.id).credit_store.close()
+        self.measure(size, 'sync new members', sync_new_members, lambda: self.fresh_guild(size))
+        self.bot.get_all_member_credit_information(guild)
+        guild_state = self.bot.guild_states.get(guild.id)
+        self.measure(size, 'sync unchanged members', lambda _: self.bot.get_all_member_credit_information(guild))
+
+        # Credit changes, directly and through a role
+        self.measure(size, 'add credits', lambda _: self.handle(guild, '!ussr add 10'))
+        role = FakeRole(guild.members[:self.role_size])
+        self.measure(size, 'add credits to a role', lambda _: self.handle(guild, '!ussr add 10', role_mentions=[role]))
+
+        # Leader board pages, clearing the cache so every repeat builds its rows
+        def leader_board(page):
+            self.bot.result_cache.clear()
+            self.handle(guild, f'!ussr leaderboard {page}')
+        self.measure(size, 'leaderboard first page', leader_board, lambda: 1)
+        self.measure(size, 'leaderboard middle page', leader_board, lambda: size // 40)
+
+        # Saving, in memory and then to the credit store
+        def save_credits(users):
+            guild_state.save_credits(*users)
+        self.measure(size, 'save credits one user', save_credits, lambda: [guild.members[size // 2].id])
+        self.measure(size, 'save credits tenth of users', save_credits,
+                     lambda: [member.id for member in guild.members[::10]])
+        self.measure(size, 'write credits tenth of users', lambda _: guild_state.credit_writer.write_now(),
+                     lambda: guild_state.credit_writer.mark(*[member.id for member in guild.members[::10]]))
+
+        # Loading the server from a fully written store, the way the bot does on startup
+        guild_state.credit_writer.write_now()
+        if hasattr(guild_state.credit_store, 'compact'):
+            guild_state.credit_store.compact(guild_state.credit_store.snapshot_all())
+        guild_state.credit_history.save()
+
+        def load(loaded_guild_state):
+            loaded_guild_state.load()
+            loaded_guild_state.credit_writer.close()
+        self.measure(size, 'load server', load, lambda: GuildState(guild.id))
+
+
+def compare(results: dict, baseline: dict):
+    """
+    Print how much faster or slower each benchmark is than the baseline
+
+    :param results: Results of this run
+    :param baseline: Results of the baseline run
+    """
+    print(f'\n{"Members":>8} {"Benchmark":<32}{"baseline ms":>12}{"now ms":>12}{"change":>9}')
+    for size, benchmarks in results.items():
+        for name, timing in benchmarks.items():
+            baseline_timing = baseline.get(size, {}).get(name)
+            if baseline_timing is None:
+                continue
+            change = timing['median'] / baseline_timing['median'] - 1 if baseline_timing['median'] else 0
+            print(f'{int(size):>8,} {name:<32}{baseline_timing["median"]:>12.2f}{timing["median"]:>12.2f}'
+                  f'{change:>+9.0%}')
+
+
+def main():
+    """
+    Run the benchmarks and compare them against, or save them as, the baseline
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the bot on synthetic servers')
+    parser.add_argument('--sizes', default=os.getenv('BENCHMARK_SIZES', '1000,10000,100000'),
+                        help='comma separated member counts of the servers to benchmark')
+    parser.add_argument('--repeat', type=int, default=int(os.getenv('BENCHMARK_REPEAT', 5)),
+                        help='times to run each benchmark')
+    parser.add_argument('--role-size', type=int, default=1000, help='most members of the mentioned role')
+    parser.add_argument('--baseline', default='../extra_files/benchmark_baseline.json',
+                        help='JSON file of the results to compare against')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    arguments = parser.parse_args()
+    baseline_file = os.path.abspath(arguments.baseline)
+
+    print(f'{"Members":>8} {"Benchmark":<32}{"min ms":>12}{"median ms":>12}')
+    sizes = [int(size) for size in arguments.sizes.split(',')]
+    results = Benchmark(sizes, arguments.repeat, arguments.role_size).run()
+
+    if arguments.save:
+        with open(baseline_file, 'w') as file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'credit store': os.getenv('CREDIT_STORE', 'json'), 'results': results}, file, indent=4)
+        print(f'\nSaved the baseline to {baseline_file}')
+    elif os.path.isfile(baseline_file):
+        with open(baseline_file, 'r') as file:
+            compare(results, json.load(file)['results'])
+    else:
+        print(f'\nNo baseline at {baseline_file}, run with --save to create one', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
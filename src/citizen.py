@@ -0,0 +1,62 @@
+"""
+Compact record of a single citizen's credits and stock market holdings
+"""
+
+
+class Citizen:
+    """
+    Everything stored for a citizen, keyed by their discord id
+
+    Only the stock market holdings above zero are kept, so a citizen costs the same no matter how many teams there are.
+    """
+
+    __slots__ = ['id', 'name', 'display_name', 'credits', 'stock_market']
+
+    def __init__(self, user_id: int, name: str, display_name: str, credits: int = 0, stock_market: dict = None):
+        """
+        Everything stored for a citizen, keyed by their discord id
+
+        :param user_id: Discord id of the citizen
+        :param name: Discord name of the citizen
+        :param display_name: Name the citizen shows as in the server
+        :param credits: Social credits of the citizen
+        :param stock_market: Money and holdings of the citizen, or None if they do not play the stock market
+        """
+        self.id = user_id
+        self.name = name
+        self.display_name = display_name
+        self.credits = credits
+        self.stock_market = stock_market
+
+    @property
+    def mention(self) -> str:
+        """
+        Text to mention the citizen in discord
+        """
+        return f'<@{self.id}>'
+
+    @classmethod
+    def from_json(cls, name: str, information: dict):
+        """
+        Create the citizen from its stored information, either the current format or the old one keyed by name
+
+        :param name: Key the information was stored under, the citizen's name in the old format
+        :param information: Stored information of the citizen
+        :return: Citizen
+        """
+        stock_market = information.get('stock_market')
+        if stock_market is not None:
+            stock_market = {team: amount for team, amount in stock_market.items() if amount or team == 'money'}
+        return cls(information['id'], information.get('name', name), information['display name'],
+                   information['credits'], stock_market)
+
+    def to_json(self) -> dict:
+        """
+        Copy the citizen's information so it can be written while the citizen keeps changing
+
+        :return: Dictionary of the citizen's information
+        """
+        information = {'id': self.id, 'name': self.name, 'display name': self.display_name, 'credits': self.credits}
+        if self.stock_market is not None:
+            information['stock_market'] = dict(self.stock_market)
+        return information
@@ -0,0 +1,81 @@
+"""
+Per-message state for the commands, so multiple commands can be handled at the same time
+"""
+
+import asyncio
+
+from contextlib import asynccontextmanager
+
+
+class CommandContext:
+    """
+    Everything about the message a command is being handled for
+    """
+
+    def __init__(self, message: object, command: object, guild_state: object, outbound_queue: object):
+        """
+        Everything about the message a command is being handled for
+
+        :param message: Discord message that triggered the command
+        :param command: ParsedCommand the message was parsed into
+        :param guild_state: GuildState of the server the message was sent in
+        :param outbound_queue: OutboundQueue to send the replies through
+        """
+        self.message = message
+        self.command = command
+        self.guild_state = guild_state
+        self.credits = guild_state.credits
+        self.user = message.author.id
+        self.display_name = message.author.display_name
+        self.post_credits = False
+        self.outbound_queue = outbound_queue
+
+    def send(self, content: str = None, file: object = None) -> asyncio.Future:
+        """
+        Queue a reply in the channel the command was sent in
+
+        :param content: Text of the reply
+        :param file: Discord file to attach to the reply
+        :return: Future that is done once the reply has been sent
+        """
+        return self.outbound_queue.send(self.message.channel, content, file)
+
+
+class UserLocks:
+    """
+    Async lock for each user so changes to the same user's credits or stocks never interleave
+    """
+
+    def __init__(self):
+        """
+        Async lock for each user so changes to the same user's credits or stocks never interleave
+        """
+        self.locks = {}
+
+    @asynccontextmanager
+    async def hold(self, *users: int):
+        """
+        Hold the locks of every given user for the duration of the with block
+
+        :param users: IDs of the users to lock
+        """
+        # Always lock in the same order so two commands locking overlapping users cannot deadlock
+        users = sorted(set(users))
+        for user in users:
+            self.locks.setdefault(user, [asyncio.Lock(), 0])[1] += 1
+
+        acquired = []
+        try:
+            for user in users:
+                await self.locks[user][0].acquire()
+                acquired.append(user)
+            yield
+        finally:
+            for user in acquired:
+                self.locks[user][0].release()
+
+            # Drop locks nobody is using so the table only holds users with commands in flight
+            for user in users:
+                self.locks[user][1] -= 1
+                if self.locks[user][1] == 0:
+                    del self.locks[user]
@@ -0,0 +1,132 @@
+"""
+Profile a sampled fraction of the commands with cProfile and tracemalloc, keeping the slowest ones to look at later
+"""
+
+import io
+import os
+import time
+import heapq
+import random
+import pstats
+import cProfile
+import tracemalloc
+
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class CommandProfiler:
+    """
+    Sampled cProfile and tracemalloc profiles of the commands, only the slowest of which are kept
+    """
+
+    def __init__(self, sample_rate: float = None, keep: int = None, stats_lines: int = None):
+        """
+        Sampled cProfile and tracemalloc profiles of the commands, only the slowest of which are kept
+
+        :param sample_rate: Fraction of the commands to profile, defaults to PROFILE_SAMPLE_RATE or 0.1
+        :param keep: Number of the slowest profiles to keep, defaults to PROFILE_KEEP or 10
+        :param stats_lines: Functions and allocation sites to keep of each profile, defaults to PROFILE_STATS_LINES or
+                            25
+        """
+        self.enabled = os.getenv('PROFILE_COMMANDS', 'false').lower() == 'true'
+        self.sample_rate = sample_rate or float(os.getenv('PROFILE_SAMPLE_RATE', 0.1))
+        self.keep = keep or int(os.getenv('PROFILE_KEEP', 10))
+        self.stats_lines = stats_lines or int(os.getenv('PROFILE_STATS_LINES', 25))
+        self.profiles = []
+        self.profiled = 0
+        self.active = False
+
+    @contextmanager
+    def profile(self, command: str):
+        """
+        Profile the with block if profiling is turned on and the block is sampled
+
+        Only one command is profiled at a time, as Python only allows a single profiler. Anything that runs while the
+        command awaits is counted in its profile too.
+
+        :param command: Name of the command being run
+        """
+        if not self.enabled or self.active or random.random() >= self.sample_rate:
+            yield
+            return
+
+        self.active = True
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile()
+        start_time = time.perf_counter()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            seconds = time.perf_counter() - start_time
+            peak_memory = tracemalloc.get_traced_memory()[1] - start_memory
+            snapshot = tracemalloc.take_snapshot() if not tracing else None
+            if not tracing:
+                tracemalloc.stop()
+            self.active = False
+            self.add_profile(command, seconds, peak_memory, profiler, snapshot)
+
+    def add_profile(self, command: str, seconds: float, peak_memory: int, profiler: cProfile.Profile,
+                    snapshot: tracemalloc.Snapshot):
+        """
+        Keep the profile if it is one of the slowest
+
+        :param command: Name of the command that was profiled
+        :param seconds: Time the command took
+        :param peak_memory: Most bytes allocated at once during the command
+        :param profiler: Profile of the command
+        :param snapshot: Memory still allocated at the end of the command, or None if something else is tracing
+        """
+        self.profiled += 1
+        if len(self.profiles) == self.keep and seconds <= self.profiles[0][0]:
+            return
+
+        # Only format the profiles that are kept
+        stats = io.StringIO()
+        pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(self.stats_lines)
+        allocations = '\n'.join(str(statistic) for statistic in snapshot.statistics('lineno')[:self.stats_lines]) \
+            if snapshot is not None else 'Not available while something else is tracing the memory'
+        report = f'{command} took {seconds * 1000:.1f} ms at {time.strftime("%Y-%m-%d %H:%M:%S")}, peaking at ' \
+                 f'{peak_memory / 1024:,.0f} KiB allocated\n\nAllocations left at the end:\n{allocations}\n\n' \
+                 f'{stats.getvalue()}'
+
+        # Min heap on the time, so the fastest kept profile is the one dropped
+        if len(self.profiles) == self.keep:
+            heapq.heapreplace(self.profiles, (seconds, self.profiled, report))
+        else:
+            heapq.heappush(self.profiles, (seconds, self.profiled, report))
+
+    def dump(self) -> str:
+        """
+        Get every kept profile, slowest first
+
+        :return: Text of the profiles
+        """
+        header = f'{len(self.profiles)} slowest of {self.profiled} profiled commands, sampling ' \
+                 f'{self.sample_rate:.0%} of the commands\n'
+        profiles = sorted(self.profiles, reverse=True)
+        return header + ''.join(f'\n{"=" * 120}\n{report}' for _, _, report in profiles)
+
+    def save(self, profile_file: str):
+        """
+        Write every kept profile to a file
+
+        :param profile_file: File to write the profiles to
+        """
+        with open(profile_file, 'w', encoding='utf-8') as file:
+            file.write(self.dump())
+
+    def clear(self):
+        """
+        Drop every kept profile
+        """
+        self.profiles = []
+        self.profiled = 0
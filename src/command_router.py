@@ -0,0 +1,219 @@
+"""
+Turn the content of a discord message into a command, splitting it only once and resolving every alias up front
+"""
+
+import time
+
+
+class ParsedCommand:
+    """
+    Command with its aliases resolved and its arguments validated
+    """
+
+    def __init__(self, content: str, tokens: list, group: str, action: str):
+        """
+        Command with its aliases resolved and its arguments validated
+
+        :param content: Content of the message
+        :param tokens: Content split on whitespace
+        :param group: Command group the message is for, either ussr, stocks, or birthday
+        :param action: Resolved sub command, or None if only the group was given
+        """
+        self.content = content
+        self.tokens = tokens
+        self.group = group
+        self.action = action
+        self.arguments = tokens[2:] if action is not None else []
+        self.amount = None
+        self.page = None
+        self.team = None
+        self.teams = []
+        self.error = None
+
+
+class CommandRouter:
+    """
+    Parse discord messages into commands
+    """
+
+    def __init__(self):
+        """
+        Parse discord messages into commands
+        """
+        self.groups = {
+            'USSR': 'ussr',
+            'ussr': 'ussr',
+            'stock': 'stocks',
+            'stocks': 'stocks',
+            'stonk': 'stocks',
+            'stonks': 'stocks',
+            'birthday': 'birthday'
+        }
+        self.actions = {
+            'ussr': {
+                'add': 'add',
+                'remove': 'remove',
+                'set': 'set',
+                'leaderboard': 'leaderboard',
+                'top': 'top',
+                'around': 'around',
+                'history': 'history',
+                'stats': 'stats',
+                'profile': 'profile',
+                'help': 'help'
+            },
+            'stocks': {
+                'teams': 'team',
+                'team': 'team',
+                'league': 'league',
+                'lcs': 'league',
+                'buy': 'buy',
+                'purchase': 'buy',
+                'sell': 'sell',
+                'status': 'status',
+                'help': 'help',
+                'leaderboard': 'leaderboard'
+            }
+        }
+        self.validators = {
+            ('ussr', 'add'): self.validate_credit_amount,
+            ('ussr', 'remove'): self.validate_credit_amount,
+            ('ussr', 'set'): self.validate_credit_amount,
+            ('ussr', 'leaderboard'): self.validate_page,
+            ('ussr', 'top'): self.validate_top_amount,
+            ('ussr', 'profile'): self.validate_profile,
+            ('stocks', 'team'): self.validate_teams,
+            ('stocks', 'buy'): self.validate_trade,
+            ('stocks', 'sell'): self.validate_trade
+        }
+
+    def parse(self, content: str):
+        """
+        Parse the message content into a command
+
+        :param content: Content of the message
+        :return: ParsedCommand, or None if the message is not a command for the bot
+        """
+        # Reject ordinary chat before doing any other work
+        if not content.startswith('!'):
+            return None
+        tokens = content.split()
+        group = self.groups.get(tokens[0][1:])
+        if group is None:
+            return None
+
+        # Only the group was given
+        if len(tokens) == 1:
+            return ParsedCommand(content, tokens, group, None)
+
+        # Birthdays take the name of who to wish happy birthday as the argument
+        if group == 'birthday':
+            command = ParsedCommand(content, tokens, group, None)
+            command.arguments = tokens[1:]
+            return command
+
+        action = self.actions[group].get(tokens[1])
+        command = ParsedCommand(content, tokens, group, action)
+        if action is None:
+            command.error = f'Unknown command: {tokens[1]}. Use the following command for help.\n!{group} help'
+        elif (group, action) in self.validators:
+            self.validators[(group, action)](command)
+        return command
+
+    @staticmethod
+    def validate_credit_amount(command: ParsedCommand):
+        """
+        Validate the amount of credits to add, remove, or set
+
+        :param command: Command to validate
+        """
+        if len(command.arguments) == 0:
+            command.error = f'Missing amount. Use the following command for help.\n!ussr help'
+            return
+        try:
+            command.amount = int(command.arguments[0])
+        except ValueError:
+            command.error = f'Invalid amount: {command.arguments[0]}. Use the following command for help.\n!ussr help'
+
+    @staticmethod
+    def validate_page(command: ParsedCommand):
+        """
+        Validate the leader board page, defaulting to the first page
+
+        :param command: Command to validate
+        """
+        try:
+            command.page = int(command.arguments[0]) if command.arguments else 1
+        except ValueError:
+            command.error = f'Invalid page: {command.arguments[0]}. Use the following command for help.\n!ussr help'
+
+    @staticmethod
+    def validate_top_amount(command: ParsedCommand):
+        """
+        Validate the number of citizens to show, defaulting to 10
+
+        :param command: Command to validate
+        """
+        try:
+            command.amount = min(max(int(command.arguments[0]), 1), 100) if command.arguments else 10
+        except ValueError:
+            command.error = f'Invalid amount: {command.arguments[0]}. Use the following command for help.\n!ussr help'
+
+    @staticmethod
+    def validate_profile(command: ParsedCommand):
+        """
+        Validate the profiling option, and the fraction of commands to profile when turning it on
+
+        :param command: Command to validate
+        """
+        options = ['on', 'off', 'dump', 'save', 'clear']
+        if len(command.arguments) == 0 or command.arguments[0] not in options:
+            command.error = f'Profile needs one of: {", ".join(options)}. Use the following command for help.\n' \
+                            f'!ussr help'
+            return
+
+        # The amount is the fraction of commands to profile
+        if command.arguments[0] == 'on' and len(command.arguments) > 1:
+            try:
+                command.amount = min(max(float(command.arguments[1]), 0.0), 1.0)
+            except ValueError:
+                command.error = f'Invalid fraction: {command.arguments[1]}. Use the following command for help.\n' \
+                                f'!ussr help'
+
+    @staticmethod
+    def validate_teams(command: ParsedCommand):
+        """
+        Normalize the team abbreviations
+
+        :param command: Command to validate
+        """
+        command.teams = [team.replace(',', '').strip().upper() for team in command.arguments]
+
+    @staticmethod
+    def validate_trade(command: ParsedCommand):
+        """
+        Validate the team and number of stocks to buy or sell
+
+        :param command: Command to validate
+        """
+        if len(command.arguments) < 2:
+            command.error = 'Not enough commands, see !stocks help for guidance.'
+            return
+        command.team = command.arguments[0].upper()
+        try:
+            command.amount = int(command.arguments[1])
+        except ValueError:
+            command.error = 'Invalid number of stocks, see !stocks help for guidance.'
+
+
+if __name__ == '__main__':
+    # Micro benchmark of how many messages per second the router can handle
+    router = CommandRouter()
+    messages = ['hello everyone', 'lol', '!play some song', '!ussr', '!ussr add 100', '!USSR leaderboard 2',
+                '!stocks', '!stonks team tl c9, tsm', '!stocks buy tl 5', '!ussr bogus', '']
+    iterations = 200000
+    start = time.perf_counter()
+    for cnt in range(iterations):
+        router.parse(messages[cnt % len(messages)])
+    elapsed = time.perf_counter() - start
+    print(f'{iterations / elapsed:,.0f} messages/sec ({elapsed / iterations * 1e6:.2f} us per message)')
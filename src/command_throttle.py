@@ -0,0 +1,137 @@
+"""
+Stop a single user or channel from monopolizing the bot, checked before any other work is done for a command
+"""
+
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class TokenBuckets:
+    """
+    Token bucket for each key, refilling at a steady rate up to a burst size
+    """
+
+    def __init__(self, rate: float, burst: float):
+        """
+        Token bucket for each key, refilling at a steady rate up to a burst size
+
+        :param rate: Tokens added each second
+        :param burst: Most tokens a bucket can hold
+        """
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}
+
+    def tokens(self, key: object, now: float) -> float:
+        """
+        Get the tokens in the key's bucket, including those refilled since it was last used
+
+        :param key: Key of the bucket
+        :param now: Current monotonic time
+        :return: Tokens in the bucket
+        """
+        tokens, last_time = self.buckets.get(key, (self.burst, now))
+        return min(tokens + (now - last_time) * self.rate, self.burst)
+
+    def take(self, key: object, cost: float, now: float):
+        """
+        Take tokens from the key's bucket, after checking it has enough with tokens()
+
+        :param key: Key of the bucket
+        :param cost: Tokens to take
+        :param now: Current monotonic time
+        """
+        self.buckets[key] = (self.tokens(key, now) - cost, now)
+
+    def prune(self, now: float):
+        """
+        Drop the buckets that have refilled, they are the same as a new bucket
+
+        :param now: Current monotonic time
+        """
+        self.buckets = {key: (tokens, last_time) for key, (tokens, last_time) in self.buckets.items()
+                        if tokens + (now - last_time) * self.rate < self.burst}
+
+
+class CommandThrottle:
+    """
+    Per user and per channel limits on commands, and merging of identical commands already being handled
+    """
+
+    # Commands that fetch the stock market or render an image cost more than the rest
+    expensive_commands = {
+        ('stocks', None), ('stocks', 'league'), ('stocks', 'team'), ('stocks', 'status'), ('stocks', 'leaderboard'),
+        ('ussr', 'leaderboard'), ('ussr', 'top'), ('ussr', 'around'), ('ussr', 'history')
+    }
+
+    # Read-only commands whose reply does not depend on who sent them, so identical ones can share a reply
+    shared_commands = {
+        ('stocks', None), ('stocks', 'league'), ('stocks', 'team'), ('stocks', 'leaderboard'), ('stocks', 'help'),
+        ('ussr', 'leaderboard'), ('ussr', 'top'), ('ussr', 'help')
+    }
+
+    def __init__(self):
+        """
+        Per user and per channel limits on commands, and merging of identical commands already being handled
+        """
+        self.expensive_cost = float(os.getenv('THROTTLE_EXPENSIVE_COST', 3))
+        self.user_buckets = TokenBuckets(float(os.getenv('THROTTLE_USER_RATE', 0.2)),
+                                         float(os.getenv('THROTTLE_USER_BURST', 6)))
+        self.channel_buckets = TokenBuckets(float(os.getenv('THROTTLE_CHANNEL_RATE', 1)),
+                                            float(os.getenv('THROTTLE_CHANNEL_BURST', 20)))
+        self.warned = {}
+        self.in_flight = set()
+        self.next_prune = 0
+
+    def allow(self, message: object, command: object) -> bool:
+        """
+        Check if the command can run, charging the author's and the channel's buckets if it can
+
+        :param message: Discord message of the command
+        :param command: ParsedCommand of the message
+        :return: Boolean indicating if the command can run
+        """
+        now = time.monotonic()
+        if now >= self.next_prune:
+            self.user_buckets.prune(now)
+            self.channel_buckets.prune(now)
+            self.warned = {user: warned_time for user, warned_time in self.warned.items() if warned_time > now}
+            self.next_prune = now + 60
+
+        # Only charge either bucket if both can pay, so users are not drained by commands turned away by the channel
+        cost = self.expensive_cost if (command.group, command.action) in self.expensive_commands else 1
+        if self.user_buckets.tokens(message.author.id, now) < cost \
+                or self.channel_buckets.tokens(message.channel.id, now) < cost:
+            return False
+        self.user_buckets.take(message.author.id, cost, now)
+        self.channel_buckets.take(message.channel.id, cost, now)
+        return True
+
+    def should_warn(self, user: int) -> bool:
+        """
+        Check if the user should be told they are being throttled, which is at most once a minute
+
+        :param user: ID of the user
+        :return: Boolean indicating if the user should be warned
+        """
+        now = time.monotonic()
+        if self.warned.get(user, 0) > now:
+            return False
+        self.warned[user] = now + 60
+        return True
+
+    def shared_key(self, message: object, command: object):
+        """
+        Get the key identical commands in the same channel share
+
+        :param message: Discord message of the command
+        :param command: ParsedCommand of the message
+        :return: Tuple identifying the command, or None if its reply depends on who sent it
+        """
+        if command.error or (command.group, command.action) not in self.shared_commands:
+            return None
+        return message.channel.id, command.group, command.action, tuple(command.arguments)
@@ -0,0 +1,125 @@
+"""
+Record the commands the bot receives as a JSONL trace, and synthesize traces, for the load test to replay
+
+Each line of a trace is a command:
+    {"time": 1634412345.25, "guild": 1, "channel": 10, "author": 100, "administrator": false,
+     "content": "!ussr add 5", "mentions": [101], "role_mentions": [[102, 103]]}
+"""
+
+import os
+import json
+import random
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class TraceRecorder:
+    """
+    Append every command the bot receives to a trace file
+    """
+
+    def __init__(self, trace_file: str):
+        """
+        Append every command the bot receives to a trace file
+
+        :param trace_file: JSONL file to append the commands to
+        """
+        self.trace = open(trace_file, 'a', encoding='utf-8')
+
+    def record(self, message: object, timestamp: float):
+        """
+        Append the command to the trace
+
+        :param message: Discord message of the command
+        :param timestamp: Time the command was received
+        """
+        self.trace.write(json.dumps({
+            'time': timestamp, 'guild': message.guild.id, 'channel': message.channel.id,
+            'author': message.author.id, 'administrator': message.author.guild_permissions.administrator,
+            'content': message.content, 'mentions': [member.id for member in message.mentions],
+            'role_mentions': [[member.id for member in role.members] for role in message.role_mentions]
+        }) + '\n')
+        self.trace.flush()
+
+    def close(self):
+        """
+        Close the trace file
+        """
+        self.trace.close()
+
+
+def create_trace_recorder():
+    """
+    Create a trace recorder if RECORD_TRACE names a file to record to
+
+    :return: TraceRecorder, or None if commands are not being recorded
+    """
+    trace_file = os.getenv('RECORD_TRACE')
+    return TraceRecorder(trace_file) if trace_file else None
+
+
+def read_trace(trace_file: str) -> list:
+    """
+    Read a trace, making the times relative to its first command
+
+    :param trace_file: JSONL file of the commands
+    :return: List of the commands in the order they were received
+    """
+    with open(trace_file, 'r', encoding='utf-8') as trace:
+        commands = [json.loads(line) for line in trace if line.strip()]
+    commands.sort(key=lambda command: command['time'])
+    start_time = commands[0]['time'] if commands else 0
+    for command in commands:
+        command['time'] -= start_time
+        command.setdefault('administrator', False)
+        command.setdefault('mentions', [])
+        command.setdefault('role_mentions', [])
+    return commands
+
+
+def synthesize_trace(trace_file: str, commands: int, rate: float, guilds: int = 1, channels: int = 4,
+                     members: int = 1000, seed: int = 0):
+    """
+    Write a trace of commands arriving at random like they do during a game day, mostly people checking the stock
+    market and their credits
+
+    :param trace_file: JSONL file to write the commands to
+    :param commands: Number of commands in the trace
+    :param rate: Average commands a second
+    :param guilds: Number of servers the commands are spread across
+    :param channels: Number of channels in each server
+    :param members: Number of members in each server
+    :param seed: Seed of the random numbers, so the same arguments always give the same trace
+    """
+    rng = random.Random(seed)
+    teams = ['TL', 'C9', 'TSM', '100', 'EG', 'FLY', 'CLG', 'DIG', 'GG', 'IMT']
+    templates = [
+        [20, lambda: '!stocks'],
+        [15, lambda: f'!stocks team {rng.choice(teams)}'],
+        [10, lambda: '!stocks status'],
+        [5, lambda: f'!stocks buy {rng.choice(teams)} {rng.randint(1, 10)}'],
+        [5, lambda: '!stocks leaderboard'],
+        [15, lambda: '!ussr'],
+        [10, lambda: f'!ussr add {rng.randint(1, 100)}'],
+        [5, lambda: f'!ussr leaderboard {rng.randint(1, 5)}'],
+        [5, lambda: '!ussr top 10'],
+        [5, lambda: '!ussr around me'],
+        [5, lambda: '!ussr history']
+    ]
+    weights = [weight for weight, _ in templates]
+
+    timestamp = 0.0
+    with open(trace_file, 'w', encoding='utf-8') as trace:
+        for _ in range(commands):
+            timestamp += rng.expovariate(rate)
+            guild = rng.randint(1, guilds)
+            content = rng.choices(templates, weights)[0][1]()
+            mentions = [guild * 1000000 + rng.randint(1, members)] if content.startswith('!ussr add') and \
+                rng.random() < 0.5 else []
+            trace.write(json.dumps({
+                'time': round(timestamp, 3), 'guild': guild, 'channel': guild * 1000 + rng.randint(1, channels),
+                'author': guild * 1000000 + rng.randint(1, members), 'administrator': False, 'content': content,
+                'mentions': mentions, 'role_mentions': []
+            }) + '\n')
@@ -0,0 +1,266 @@
+"""
+Keep a bounded history of every citizen's credits, with the older points thinned out, and chart it
+"""
+
+import io
+import os
+import sys
+import time
+import struct
+
+from array import array
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+# Balances are stored as 64 bit integers, so anything past them is clamped
+LARGEST_BALANCE = 2 ** 63 - 1
+SMALLEST_BALANCE = -2 ** 63
+
+
+class RingBuffer:
+    """
+    Fixed number of (timestamp, balance) points, overwriting the oldest point once full
+    """
+
+    __slots__ = ['capacity', 'times', 'balances', 'start']
+
+    def __init__(self, capacity: int):
+        """
+        Fixed number of (timestamp, balance) points, overwriting the oldest point once full
+
+        :param capacity: Most points to keep
+        """
+        self.capacity = capacity
+        self.times = array('q')
+        self.balances = array('q')
+        self.start = 0
+
+    def append(self, timestamp: int, balance: int):
+        """
+        Add a point, growing the arrays until they reach the capacity
+
+        :param timestamp: Time of the point in seconds
+        :param balance: Credits at that time
+        :return: Overwritten (timestamp, balance) point, or None if the buffer was not full
+        """
+        if len(self.times) < self.capacity:
+            self.times.append(timestamp)
+            self.balances.append(balance)
+            return None
+        overwritten = self.times[self.start], self.balances[self.start]
+        self.times[self.start] = timestamp
+        self.balances[self.start] = balance
+        self.start = (self.start + 1) % self.capacity
+        return overwritten
+
+    def points(self) -> tuple:
+        """
+        Get the points from oldest to newest
+
+        :return: Tuple of the list of timestamps and the list of balances
+        """
+        return (self.times[self.start:].tolist() + self.times[:self.start].tolist(),
+                self.balances[self.start:].tolist() + self.balances[:self.start].tolist())
+
+
+class UserHistory:
+    """
+    Recent points at full detail, and every few older points kept in an archive
+    """
+
+    __slots__ = ['recent', 'archive', 'evicted']
+
+    def __init__(self, recent_points: int, archive_points: int):
+        """
+        Recent points at full detail, and every few older points kept in an archive
+
+        :param recent_points: Most points to keep at full detail
+        :param archive_points: Most older points to keep
+        """
+        self.recent = RingBuffer(recent_points)
+        self.archive = RingBuffer(archive_points)
+        self.evicted = 0
+
+    def append(self, timestamp: int, balance: int, downsample: int):
+        """
+        Add a point, moving every downsample-th point pushed out of the recent points into the archive
+
+        :param timestamp: Time of the point in seconds
+        :param balance: Credits at that time
+        :param downsample: Number of old points each archived point stands for
+        """
+        overwritten = self.recent.append(timestamp, balance)
+        if overwritten is not None:
+            if self.evicted % downsample == 0:
+                self.archive.append(*overwritten)
+            self.evicted += 1
+
+    def points(self) -> tuple:
+        """
+        Get every point from oldest to newest
+
+        :return: Tuple of the list of timestamps and the list of balances
+        """
+        archive_times, archive_balances = self.archive.points()
+        recent_times, recent_balances = self.recent.points()
+        return archive_times + recent_times, archive_balances + recent_balances
+
+
+class CreditHistory:
+    """
+    Credit history of every citizen of a server
+    """
+
+    def __init__(self, history_file: str, recent_points: int = None, archive_points: int = None,
+                 downsample: int = None):
+        """
+        Credit history of every citizen of a server
+
+        :param history_file: Binary file the history is saved to
+        :param recent_points: Points to keep at full detail, defaults to HISTORY_RECENT_POINTS or 64
+        :param archive_points: Older points to keep, defaults to HISTORY_ARCHIVE_POINTS or 64
+        :param downsample: Old points for each archived point, defaults to HISTORY_DOWNSAMPLE or 8
+        """
+        self.history_file = history_file
+        self.recent_points = recent_points or int(os.getenv('HISTORY_RECENT_POINTS', 64))
+        self.archive_points = archive_points or int(os.getenv('HISTORY_ARCHIVE_POINTS', 64))
+        self.downsample = downsample or int(os.getenv('HISTORY_DOWNSAMPLE', 8))
+        self.users = {}
+        self.changed = False
+
+    def record(self, user: int, balance: int, timestamp: int = None):
+        """
+        Record the user's balance if it changed since their last point, or since they started with nothing
+
+        :param user: ID of the user
+        :param balance: User's current credits
+        :param timestamp: Time of the change in seconds, defaults to now
+        """
+        balance = min(max(balance, SMALLEST_BALANCE), LARGEST_BALANCE)
+        history = self.users.get(user)
+        if history is None:
+
+            # New members start at nothing, so they only get a history once their credits actually change
+            if balance == 0:
+                return
+            history = self.users[user] = UserHistory(self.recent_points, self.archive_points)
+        elif len(history.recent.balances) and \
+                history.recent.balances[history.recent.start - 1] == balance:
+            return
+        history.append(int(timestamp if timestamp is not None else time.time()), balance, self.downsample)
+        self.changed = True
+
+    def remove(self, user: int):
+        """
+        Drop the user's history
+
+        :param user: ID of the user
+        """
+        if self.users.pop(user, None) is not None:
+            self.changed = True
+
+    def points(self, user: int) -> tuple:
+        """
+        Get the user's history from oldest to newest
+
+        :param user: ID of the user
+        :return: Tuple of the list of timestamps and the list of balances, both empty if there is no history
+        """
+        history = self.users.get(user)
+        return history.points() if history is not None else ([], [])
+
+    def load(self):
+        """
+        Read the history saved by save()
+        """
+        try:
+            with open(self.history_file, 'rb') as history_file:
+                data = history_file.read()
+        except FileNotFoundError:
+            return
+
+        header = struct.Struct('<qIIIIQ')
+        offset = 0
+        try:
+            while offset < len(data):
+                user, recent_start, recent_length, archive_start, archive_length, evicted = \
+                    header.unpack_from(data, offset)
+                offset += header.size
+                history = UserHistory(max(self.recent_points, recent_length), max(self.archive_points, archive_length))
+                for ring, start, length in [[history.recent, recent_start, recent_length],
+                                            [history.archive, archive_start, archive_length]]:
+                    for values in [ring.times, ring.balances]:
+                        values.frombytes(data[offset:offset + length * 8])
+                        offset += length * 8
+
+                    # Put the oldest point first, so the buffer still works if its capacity changed
+                    ring.times = ring.times[start:] + ring.times[:start]
+                    ring.balances = ring.balances[start:] + ring.balances[:start]
+                history.evicted = evicted
+                self.users[user] = history
+
+        # A history cut short is only missing its last users
+        except (struct.error, ValueError) as e:
+            print(e, file=sys.stderr)
+
+    def save(self):
+        """
+        Atomically write the history of every user to the history file
+        """
+        self.write(self.serialize())
+
+    def serialize(self) -> bytes:
+        """
+        Copy the history of every user into the format of the history file, run alongside the code recording it
+
+        :return: Contents of the history file
+        """
+        header = struct.Struct('<qIIIIQ')
+        data = io.BytesIO()
+        for user, history in self.users.items():
+            data.write(header.pack(user, history.recent.start, len(history.recent.times), history.archive.start,
+                                   len(history.archive.times), history.evicted))
+            for ring in [history.recent, history.archive]:
+                data.write(ring.times.tobytes())
+                data.write(ring.balances.tobytes())
+        self.changed = False
+        return data.getvalue()
+
+    def write(self, data: bytes):
+        """
+        Atomically replace the history file, safe to run in another thread
+
+        :param data: Contents of the history file from serialize()
+        """
+        temporary_file = f'{self.history_file}.tmp'
+        with open(temporary_file, 'wb') as history_file:
+            history_file.write(data)
+        os.replace(temporary_file, self.history_file)
+
+
+def render_history_graph(display_name: str, times: list, balances: list) -> bytes:
+    """
+    Chart the credits of a citizen over time
+
+    :param display_name: Name of the citizen to title the chart with
+    :param times: Timestamps of the points in seconds
+    :param balances: Credits at each timestamp
+    :return: PNG image of the chart
+    """
+    import datetime
+    import matplotlib.pyplot as plt
+
+    with metrics.timer('matplotlib render', 'history'):
+        figure, axes = plt.subplots(figsize=(10, 5))
+        axes.step([datetime.datetime.fromtimestamp(timestamp) for timestamp in times], balances, where='post',
+                  marker='o', markersize=3)
+        axes.set_title(f'{display_name}\'s social credits')
+        axes.set_ylabel('Social Credits')
+        axes.grid(True, alpha=0.3)
+        figure.autofmt_xdate()
+        image = io.BytesIO()
+        figure.savefig(image, format='png')
+        plt.close(figure)
+    return image.getvalue()
@@ -0,0 +1,574 @@
+"""
+Persist the social credit data, either as a JSON snapshot plus an append-only log of every change or in SQLite
+
+Run from the src folder to check recovering from an interrupted compaction:
+    python credit_store.py
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from citizen import Citizen
+from metrics import metrics
+
+load_dotenv()
+
+
+def create_credit_store(guild_id: int = None):
+    """
+    Create the credit store selected by the CREDIT_STORE environment variable
+
+    :param guild_id: ID of the server to keep the credits of, or None for the single shared credit data
+    :return: SqliteCreditStore if CREDIT_STORE is sqlite, otherwise JsonCreditStore
+    """
+    name = '../extra_files/credit_data' if guild_id is None else f'../extra_files/credit_data_{guild_id}'
+    if os.getenv('CREDIT_STORE', 'json').lower() == 'sqlite':
+        return SqliteCreditStore(f'{name}.db', f'{name}.json')
+    return JsonCreditStore(f'{name}.json')
+
+
+class CreditStore:
+    """
+    Shared behaviour of the credit stores
+
+    Saving is split into taking a snapshot of the changed users, which has to happen alongside the code changing
+    them, and writing that snapshot, which is safe to do from another thread.
+    """
+
+    def __init__(self):
+        """
+        Shared behaviour of the credit stores
+        """
+        self.credits = {}
+
+    def snapshot(self, users) -> list:
+        """
+        Copy the current information of the given users
+
+        :param users: IDs of the users that changed
+        :return: List of [id, information] pairs, with None as the information for removed users
+        """
+        return [[user, self.credits[user].to_json() if user in self.credits else None] for user in users]
+
+    def save(self, *users: int):
+        """
+        Write the given users immediately
+
+        :param users: IDs of the users that changed
+        """
+        self.write(self.snapshot(users))
+
+    def write(self, records: list):
+        """
+        Write a snapshot of changed users
+
+        :param records: Snapshot from snapshot()
+        """
+        raise NotImplementedError
+
+    def needs_compaction(self) -> bool:
+        """
+        Check if the store wants a full snapshot of the credits to compact itself with
+
+        :return: Boolean indicating if compact() should be called
+        """
+        return False
+
+    def close(self):
+        """
+        Release anything held by the store
+        """
+
+
+class JsonCreditStore(CreditStore):
+    """
+    Snapshot and write-ahead log for the credit data
+    """
+
+    def __init__(self, snapshot_file: str = '../extra_files/credit_data.json', compact_after: int = 1000):
+        """
+        Snapshot and write-ahead log for the credit data
+
+        :param snapshot_file: JSON file holding the last compacted copy of the credits
+        :param compact_after: Number of logged changes before the log is folded back into the snapshot
+        """
+        super().__init__()
+        self.snapshot_file = snapshot_file
+        self.log_file = f'{os.path.splitext(snapshot_file)[0]}.log'
+        self.rotated_log_file = f'{self.log_file}.1'
+        self.compact_after = compact_after
+        self.log = None
+        self.log_records = 0
+
+    def load(self) -> dict:
+        """
+        Load the last snapshot and replay every logged change on top of it
+
+        :return: Dictionary of every user's Citizen by id
+        """
+        self.credits = {}
+        for key, user_information in self.read_snapshot().items():
+            citizen = Citizen.from_json(key, user_information)
+            self.credits[citizen.id] = citizen
+        for log_file in [self.rotated_log_file, self.log_file]:
+            self.replay_log(log_file, self.credits)
+        self.log = open(self.log_file, 'a', encoding='utf-8')
+
+        # Finish a compaction that was interrupted before the rotated log was removed
+        if os.path.isfile(self.rotated_log_file):
+            self.compact(self.snapshot_all())
+        return self.credits
+
+    def read_snapshot(self) -> dict:
+        """
+        Read the snapshot file, creating it if it does not exist or is empty
+
+        :return: Dictionary stored in the snapshot
+        """
+        try:
+            with open(self.snapshot_file, 'r', encoding='utf-8') as snapshot_file:
+                return json.load(snapshot_file)
+
+        # If the file is missing or empty, create it as an empty dictionary
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            with open(self.snapshot_file, 'w', encoding='utf-8') as snapshot_file:
+                snapshot_file.write('{\n}')
+            return {}
+
+    def replay_log(self, log_file: str, credits: dict):
+        """
+        Apply every change in the log file to the credits dictionary
+
+        :param log_file: Log file to replay
+        :param credits: Dictionary to apply the changes to
+        """
+        if not os.path.isfile(log_file):
+            return
+
+        # Logs from before the credits were keyed by id delete users by name
+        names = {citizen.name: user_id for user_id, citizen in credits.items()}
+
+        with open(log_file, 'r', encoding='utf-8') as log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+
+                # A partially written line from a crash, everything before it is still valid
+                except json.decoder.JSONDecodeError:
+                    continue
+                if record[0] == 'set':
+                    citizen = Citizen.from_json(record[1], record[2])
+                    credits[citizen.id] = citizen
+                    names[citizen.name] = citizen.id
+                elif record[0] == 'delete':
+                    credits.pop(record[1] if isinstance(record[1], int) else names.get(record[1]), None)
+                if log_file == self.log_file:
+                    self.log_records += 1
+
+    def write(self, records: list):
+        """
+        Append the changed users to the log
+
+        :param records: Snapshot from snapshot()
+        """
+        for user, user_information in records:
+            if user_information is None:
+                self.log.write(json.dumps(['delete', user]) + '\n')
+            else:
+                self.log.write(json.dumps(['set', user, user_information]) + '\n')
+        self.log.flush()
+        self.log_records += len(records)
+
+    def needs_compaction(self) -> bool:
+        """
+        Check if enough changes have been logged to fold them back into the snapshot
+
+        :return: Boolean indicating if compact() should be called
+        """
+        return self.log_records >= self.compact_after
+
+    def snapshot_all(self) -> dict:
+        """
+        Copy every user's information to compact the log with
+
+        :return: Dictionary of every user's information by id
+        """
+        return {user: citizen.to_json() for user, citizen in self.credits.items()}
+
+    def compact(self, credits: dict):
+        """
+        Atomically write a new snapshot and drop the logged changes it contains
+
+        :param credits: Copy of the credits from snapshot_all(), taken after the last write
+        """
+        # Rotate the log first so a crash part way through still replays every change
+        self.log.close()
+        if os.path.isfile(self.rotated_log_file):
+            with open(self.log_file, 'r', encoding='utf-8') as log, \
+                    open(self.rotated_log_file, 'a', encoding='utf-8') as rotated_log:
+                rotated_log.write(log.read())
+            os.remove(self.log_file)
+        else:
+            os.replace(self.log_file, self.rotated_log_file)
+        self.log = open(self.log_file, 'a', encoding='utf-8')
+        self.log_records = 0
+
+        temporary_file = f'{self.snapshot_file}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(credits, snapshot_file, indent=4)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_file, self.snapshot_file)
+        os.remove(self.rotated_log_file)
+
+    def stock_market_worth(self, prices: dict) -> list:
+        """
+        Get the total worth of every user playing the stock market
+
+        :param prices: Current price of each team
+        :return: Dual array [[display name, worth], [display name, worth]...] from the most to the least worth
+        """
+        all_rows = []
+        for citizen in self.credits.values():
+            if citizen.stock_market is not None:
+                worth = citizen.stock_market['money']
+                worth += sum(amount * prices.get(team, 0) for team, amount in citizen.stock_market.items()
+                             if team != 'money' and amount > 0)
+                all_rows.append([citizen.display_name.strip(), worth])
+        all_rows.sort(key=lambda row: row[1], reverse=True)
+        return all_rows
+
+    def close(self):
+        """
+        Close the log
+        """
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+
+class SqliteCreditStore(CreditStore):
+    """
+    SQLite database for the credit data
+    """
+
+    def __init__(self, database_file: str = '../extra_files/credit_data.db',
+                 json_snapshot_file: str = '../extra_files/credit_data.json'):
+        """
+        SQLite database for the credit data
+
+        :param database_file: SQLite database file to use
+        :param json_snapshot_file: JSON credit data to import the first time the database is created
+        """
+        super().__init__()
+        self.database_file = database_file
+        self.json_snapshot_file = json_snapshot_file
+        self.connection = None
+        self.connection_lock = threading.Lock()
+
+    def load(self) -> dict:
+        """
+        Create the tables if needed and read every user from the database
+
+        :return: Dictionary of every user's credit information
+        """
+        self.connection = sqlite3.connect(self.database_file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                display_name TEXT,
+                credits TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS holdings (
+                user_id INTEGER NOT NULL,
+                team TEXT NOT NULL,
+                amount INTEGER NOT NULL,
+                PRIMARY KEY (user_id, team)
+            );
+        ''')
+        self.drop_unused_columns()
+        self.connection.execute('CREATE INDEX IF NOT EXISTS users_name ON users (name)')
+
+        # Carry over the existing JSON data the first time the database is used
+        if self.connection.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 0 \
+                and os.path.isfile(self.json_snapshot_file):
+            json_store = JsonCreditStore(self.json_snapshot_file)
+            self.credits = json_store.load()
+            json_store.close()
+            self.save(*self.credits)
+            return self.credits
+
+        for user_id, name, display_name, credits in self.connection.execute(
+                'SELECT id, name, display_name, credits FROM users'):
+            self.credits[user_id] = Citizen(user_id, name, display_name, int(credits))
+
+        # Older databases also kept the holdings of zero
+        for user_id, team, amount in self.connection.execute(
+                "SELECT user_id, team, amount FROM holdings WHERE amount != 0 OR team = 'money'"):
+            citizen = self.credits[user_id]
+            if citizen.stock_market is None:
+                citizen.stock_market = {}
+            citizen.stock_market[team] = amount
+        return self.credits
+
+    def drop_unused_columns(self):
+        """
+        Rebuild the users table of older databases without the mention and credit order columns, which nothing reads
+        as the mention comes from the ID and the rank index sorts the credits in memory
+        """
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(users)')]
+        if 'mention' not in columns and 'credit_order' not in columns:
+            return
+
+        # Copied to a new table in one transaction, as older versions of SQLite cannot drop columns
+        self.connection.executescript('''
+            BEGIN;
+            DROP INDEX IF EXISTS users_credit_order;
+            DROP INDEX IF EXISTS users_name;
+            CREATE TABLE users_without_unused_columns (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                display_name TEXT,
+                credits TEXT NOT NULL
+            );
+            INSERT INTO users_without_unused_columns (id, name, display_name, credits)
+                SELECT id, name, display_name, credits FROM users;
+            DROP TABLE users;
+            ALTER TABLE users_without_unused_columns RENAME TO users;
+            COMMIT;
+        ''')
+
+    def write(self, records: list):
+        """
+        Upsert the changed users, replace their stock market holdings, and delete removed users, in a single
+        transaction
+
+        :param records: Snapshot from snapshot()
+        """
+        changed = [[user, user_information] for user, user_information in records if user_information is not None]
+        removed = [[user] for user, user_information in records if user_information is None]
+        with self.connection_lock, self.connection:
+            self.connection.executemany('DELETE FROM holdings WHERE user_id = ?', [[user] for user, _ in records])
+            self.connection.executemany('DELETE FROM users WHERE id = ?', removed)
+            self.connection.executemany('''
+                INSERT INTO users (id, name, display_name, credits)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET name = excluded.name, display_name = excluded.display_name,
+                    credits = excluded.credits
+            ''', [(user, user_information['name'], user_information['display name'], str(user_information['credits']))
+                  for user, user_information in changed])
+            self.connection.executemany('INSERT INTO holdings (user_id, team, amount) VALUES (?, ?, ?)',
+                                        [(user, team, amount) for user, user_information in changed
+                                         for team, amount in user_information.get('stock_market', {}).items()])
+
+    def stock_market_worth(self, prices: dict) -> list:
+        """
+        Get the total worth of every user playing the stock market
+
+        :param prices: Current price of each team
+        :return: Dual array [[display name, worth], [display name, worth]...] from the most to the least worth
+        """
+        prices = dict(prices, money=1)
+        values = ', '.join(['(?, ?)'] * len(prices))
+        query = f'''
+            WITH prices (team, price) AS (VALUES {values})
+            SELECT TRIM(users.display_name), SUM(holdings.amount * prices.price)
+            FROM holdings
+            JOIN users ON users.id = holdings.user_id
+            JOIN prices ON prices.team = holdings.team
+            WHERE holdings.amount > 0 OR holdings.team = 'money'
+            GROUP BY users.id
+            ORDER BY 2 DESC
+        '''
+        parameters = [value for team_price in prices.items() for value in team_price]
+        with self.connection_lock:
+            return [[display_name, worth] for display_name, worth in self.connection.execute(query, parameters)]
+
+    def close(self):
+        """
+        Close the database connection
+        """
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class WriteBehind:
+    """
+    Collect changed users and write them to the credit store in the background
+
+    A burst of changes is written once the changes stop for the flush delay, or once the oldest unwritten change
+    reaches the maximum staleness, whichever comes first.
+    """
+
+    def __init__(self, store: CreditStore, flush_delay: float = None, max_staleness: float = None,
+                 executor: ThreadPoolExecutor = None):
+        """
+        Collect changed users and write them to the credit store in the background
+
+        :param store: Credit store to write to
+        :param flush_delay: Seconds without changes before writing, defaults to CREDIT_FLUSH_DELAY or 2
+        :param max_staleness: Most seconds a change can wait to be written, defaults to CREDIT_MAX_STALENESS or 10
+        :param executor: Executor shared with other writers, the writer creates its own if not given
+        """
+        self.store = store
+        self.flush_delay = flush_delay if flush_delay is not None else float(os.getenv('CREDIT_FLUSH_DELAY', 2))
+        self.max_staleness = max_staleness if max_staleness is not None \
+            else float(os.getenv('CREDIT_MAX_STALENESS', 10))
+        self.dirty = set()
+        self.first_dirty = None
+        self.changed = None
+        self.flush_lock = None
+        self.task = None
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+    def mark(self, *users: int):
+        """
+        Mark the users as changed so they are written on the next flush
+
+        :param users: IDs of the users that changed
+        """
+        if not users:
+            return
+        self.dirty.update(users)
+        if self.first_dirty is None:
+            self.first_dirty = time.monotonic()
+        if self.changed is not None:
+            self.changed.set()
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Start the background flush task
+
+        :param loop: Event loop the bot is running on
+        """
+        if self.task is None:
+            self.changed = asyncio.Event()
+            self.flush_lock = asyncio.Lock()
+            self.task = loop.create_task(self.run())
+            if self.dirty:
+                self.changed.set()
+
+    async def run(self):
+        """
+        Flush whenever the changes settle or get too old
+        """
+        while True:
+            await self.changed.wait()
+            while self.dirty:
+                self.changed.clear()
+                remaining = self.max_staleness - (time.monotonic() - self.first_dirty)
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.changed.wait(), min(self.flush_delay, remaining))
+                except asyncio.TimeoutError:
+                    break
+            self.changed.clear()
+            await self.flush()
+
+    async def flush(self):
+        """
+        Write every changed user in the executor thread, compacting the store if it asks for it
+        """
+        # Nothing else can be running before the flush task has started
+        if self.flush_lock is None:
+            self.write_now()
+            return
+
+        async with self.flush_lock:
+            if not self.dirty:
+                return
+            users, self.dirty, self.first_dirty = self.dirty, set(), None
+            loop = asyncio.get_event_loop()
+            try:
+                await loop.run_in_executor(self.executor, self.write, self.store.snapshot(users))
+                if self.store.needs_compaction():
+                    await loop.run_in_executor(self.executor, self.compact, self.store.snapshot_all())
+
+            # Keep the users marked so nothing is lost, writing them twice is harmless
+            except asyncio.CancelledError:
+                self.mark(*users)
+                raise
+
+            # Any failure of the store, such as a locked SQLite database, is retried on a later flush
+            except Exception as e:
+                print(e, file=sys.stderr)
+                self.mark(*users)
+
+    def write(self, records: list):
+        """
+        Write a snapshot of changed users to the store, timing how long it takes
+
+        :param records: Snapshot from the store's snapshot()
+        """
+        with metrics.timer('save credits', 'write'):
+            self.store.write(records)
+
+    def compact(self, credits: dict):
+        """
+        Compact the store, timing how long it takes
+
+        :param credits: Copy of the credits from the store's snapshot_all()
+        """
+        with metrics.timer('save credits', 'compact'):
+            self.store.compact(credits)
+
+    def write_now(self):
+        """
+        Write every changed user from the current thread
+        """
+        if self.dirty:
+            users, self.dirty, self.first_dirty = self.dirty, set(), None
+            self.write(self.store.snapshot(users))
+
+    def close(self):
+        """
+        Stop the flush task, wait for any write in progress, write anything left and close the store
+
+        A shared executor must be shut down by its owner before closing the writer.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.owns_executor:
+            self.executor.shutdown(wait=True)
+        self.write_now()
+        self.store.close()
+
+
+if __name__ == '__main__':
+    # Recover from a compaction interrupted before the rotated log was removed, in a temporary folder
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as data_directory:
+        snapshot_file = os.path.join(data_directory, 'credit_data.json')
+        with open(snapshot_file, 'w', encoding='utf-8') as file:
+            json.dump({'1': Citizen(1, 'lenin', 'Lenin', 10).to_json()}, file)
+        with open(f'{os.path.splitext(snapshot_file)[0]}.log.1', 'w', encoding='utf-8') as file:
+            file.write(json.dumps(['set', 2, Citizen(2, 'stalin', 'Stalin', 20).to_json()]) + '\n')
+            file.write(json.dumps(['set', 1, Citizen(1, 'lenin', 'Lenin', 15).to_json()]) + '\n')
+
+        json_store = JsonCreditStore(snapshot_file)
+        credits = json_store.load()
+        json_store.close()
+        assert {user: citizen.credits for user, citizen in credits.items()} == {1: 15, 2: 20}, credits
+        assert sorted(os.listdir(data_directory)) == ['credit_data.json', 'credit_data.log'], \
+            os.listdir(data_directory)
+
+        # The recovered snapshot holds everything on its own
+        json_store = JsonCreditStore(snapshot_file)
+        os.remove(json_store.log_file)
+        credits = json_store.load()
+        json_store.close()
+        assert {user: citizen.credits for user, citizen in credits.items()} == {1: 15, 2: 20}, credits
+        print('Recovered the interrupted compaction')
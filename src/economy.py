@@ -0,0 +1,136 @@
+"""
+Run the economy of a server: passive income, progressive taxes and redistribution of the taxes to new citizens
+"""
+
+import os
+import time
+import datetime
+import numpy as np
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Balances past this are left alone, so the tax math cannot overflow 64 bit integers
+LARGEST_TAXABLE_BALANCE = 2 ** 62
+
+
+class Economy:
+    """
+    Apply an economy tick to every citizen of a server at once
+    """
+
+    def __init__(self, income: int = None, tax_brackets: list = None, new_citizen_days: float = None):
+        """
+        Apply an economy tick to every citizen of a server at once
+
+        :param income: Credits every citizen gains each tick, defaults to ECONOMY_INCOME or 10
+        :param tax_brackets: List of [threshold, rate] pairs, taxing the credits above each threshold at its rate,
+                             defaults to ECONOMY_TAX_BRACKETS such as 1000:0.01,10000:0.02
+        :param new_citizen_days: Days after joining a citizen receives the taxes, defaults to ECONOMY_NEW_CITIZEN_DAYS
+                                 or 7
+        """
+        self.income = income if income is not None else int(os.getenv('ECONOMY_INCOME', 10))
+        if tax_brackets is None:
+            brackets = os.getenv('ECONOMY_TAX_BRACKETS', '1000:0.01,10000:0.02,100000:0.05,1000000:0.1')
+            tax_brackets = [[int(bracket.split(':')[0]), float(bracket.split(':')[1])]
+                            for bracket in brackets.split(',') if bracket]
+        self.tax_brackets = sorted(tax_brackets)
+        self.new_citizen_days = new_citizen_days if new_citizen_days is not None \
+            else float(os.getenv('ECONOMY_NEW_CITIZEN_DAYS', 7))
+
+    def new_citizens(self, members: list) -> list:
+        """
+        Get the members who joined the server recently enough to receive the taxes
+
+        :param members: Every member of the server
+        :return: List of the IDs of the new members
+        """
+        joined_after = datetime.datetime.utcnow() - datetime.timedelta(days=self.new_citizen_days)
+        return [member.id for member in members if member.joined_at is not None and member.joined_at >= joined_after]
+
+    def taxes(self, balances: np.ndarray) -> np.ndarray:
+        """
+        Get the progressive tax owed on each balance
+
+        :param balances: Balance of each citizen
+        :return: Tax of each citizen
+        """
+        taxes = np.zeros(len(balances), dtype=np.float64)
+        upper_thresholds = [threshold for threshold, _ in self.tax_brackets[1:]] + [None]
+        for (threshold, rate), upper_threshold in zip(self.tax_brackets, upper_thresholds):
+            taxable = np.clip(balances - threshold, 0, None if upper_threshold is None else upper_threshold - threshold)
+            taxes += taxable * rate
+        return taxes.astype(np.int64)
+
+    def tick(self, guild_state: object, new_citizens: list) -> dict:
+        """
+        Pay everyone their income, collect the taxes and split them between the new citizens, then save every
+        changed citizen in one batch
+
+        :param guild_state: GuildState of the server
+        :param new_citizens: IDs of the citizens who receive the taxes
+        :return: Dictionary of the citizens changed, taxes collected, share of each new citizen and seconds taken
+        """
+        start_time = time.perf_counter()
+        credits = guild_state.credits
+        users = list(credits)
+        everyone = True
+        try:
+            old_balances = np.array([citizen.credits for citizen in credits.values()], dtype=np.int64)
+            if len(users) and np.abs(old_balances).max() >= LARGEST_TAXABLE_BALANCE:
+                raise OverflowError
+
+        # Leave out the citizens too rich or too poor to fit
+        except OverflowError:
+            everyone = False
+            users = [user for user, citizen in credits.items() if abs(citizen.credits) < LARGEST_TAXABLE_BALANCE]
+            old_balances = np.array([credits[user].credits for user in users], dtype=np.int64)
+        if not users:
+            return {'citizens': 0, 'taxes': 0, 'share': 0, 'seconds': time.perf_counter() - start_time}
+
+        ids = np.array(users, dtype=np.int64)
+        balances = old_balances + self.income
+        taxes = self.taxes(balances)
+        balances -= taxes
+
+        # Split the taxes evenly between the new citizens, the rest is kept by the state. Both the share and the new
+        # balances are capped so they still fit in 64 bit integers.
+        total_taxes = int(taxes.sum(dtype=np.float64))
+        receivers = np.isin(ids, np.array(new_citizens, dtype=np.int64))
+        receiver_count = int(receivers.sum())
+        share = min(total_taxes // receiver_count, LARGEST_TAXABLE_BALANCE) if receiver_count else 0
+        balances[receivers] = np.minimum(balances[receivers], LARGEST_TAXABLE_BALANCE - share) + share
+
+        changed = np.flatnonzero(balances != old_balances)
+        changed_users = [users[index] for index in changed.tolist()]
+        for user, balance in zip(changed_users, balances[changed].tolist()):
+            credits[user].credits = balance
+
+        # Everyone can be ranked by sorting the arrays, which is much faster than sorting the citizens
+        if everyone and len(changed_users) > len(users) // 8:
+            order = np.lexsort((ids, -balances))
+            guild_state.rank_index.build_sorted(ids[order].tolist(), balances[order].tolist())
+            guild_state.save_credits(*changed_users, reindex=False)
+        else:
+            guild_state.save_credits(*changed_users)
+        return {'citizens': len(changed_users), 'taxes': total_taxes, 'share': share,
+                'seconds': time.perf_counter() - start_time}
+
+
+if __name__ == '__main__':
+    # Micro benchmark of a tick over a large server
+    from guild_state import GuildState
+    from citizen import Citizen
+
+    # The server is never loaded, so nothing is written to disk
+    guild_state = GuildState(0)
+    rng = np.random.default_rng(0)
+    for user_id, balance in enumerate(rng.lognormal(6, 3, 100000).astype(np.int64).tolist()):
+        guild_state.credits[user_id] = Citizen(user_id, f'user{user_id}', f'User {user_id}', balance)
+    guild_state.rank_index.build(guild_state.credits)
+    economy = Economy()
+    for _ in range(3):
+        summary = economy.tick(guild_state, list(range(100)))
+        print(f'{summary["citizens"]:,} citizens changed, {summary["taxes"]:,} taxes, {summary["share"]:,} each to '
+              f'new citizens in {summary["seconds"] * 1000:.1f} ms')
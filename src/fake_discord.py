@@ -0,0 +1,148 @@
+"""
+Stand-ins for the discord objects the bot uses, so the benchmarks and the trace replay run without a connection
+"""
+
+import os
+import shutil
+import asyncio
+import tempfile
+
+from contextlib import contextmanager
+
+
+class FakePermissions:
+    """
+    Just enough of a member's server permissions for the bot
+    """
+
+    def __init__(self, administrator: bool = False):
+        """
+        Just enough of a member's server permissions for the bot
+
+        :param administrator: Boolean indicating if the member is a server administrator
+        """
+        self.administrator = administrator
+
+
+class FakeMember:
+    """
+    Just enough of a discord member for the bot
+    """
+
+    __slots__ = ['id', 'name', 'display_name', 'mention', 'guild_permissions']
+
+    def __init__(self, user_id: int, administrator: bool = False):
+        """
+        Just enough of a discord member for the bot
+
+        :param user_id: ID of the member
+        :param administrator: Boolean indicating if the member is a server administrator
+        """
+        self.id = user_id
+        self.name = f'citizen{user_id}'
+        self.display_name = f'Citizen {user_id}'
+        self.mention = f'<@{user_id}>'
+        self.guild_permissions = FakePermissions(administrator)
+
+
+class FakeRole:
+    """
+    Just enough of a discord role for the bot
+    """
+
+    def __init__(self, members: list):
+        """
+        Just enough of a discord role for the bot
+
+        :param members: Members with the role
+        """
+        self.members = members
+
+
+class FakeGuild:
+    """
+    Just enough of a discord server for the bot
+    """
+
+    def __init__(self, guild_id: int, members: list):
+        """
+        Just enough of a discord server for the bot
+
+        :param guild_id: ID of the server
+        :param members: Members of the server
+        """
+        self.id = guild_id
+        self.members = members
+
+
+class FakeChannel:
+    """
+    Discord channel that counts what is sent to it, taking as long as discord would to send each message
+    """
+
+    def __init__(self, channel_id: int, send_latency: float = 0):
+        """
+        Discord channel that counts what is sent to it, taking as long as discord would to send each message
+
+        :param channel_id: ID of the channel
+        :param send_latency: Seconds each message takes to send
+        """
+        self.id = channel_id
+        self.send_latency = send_latency
+        self.messages = 0
+        self.files = 0
+
+    async def send(self, content: str = None, files: list = None):
+        """
+        Pretend to send a message
+
+        :param content: Text of the message
+        :param files: Discord files attached to the message
+        """
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.messages += 1
+        self.files += len(files or [])
+
+
+class FakeMessage:
+    """
+    Just enough of a discord message for the bot
+    """
+
+    def __init__(self, content: str, guild: FakeGuild, author: FakeMember, channel: FakeChannel,
+                 mentions: list = (), role_mentions: list = ()):
+        """
+        Just enough of a discord message for the bot
+
+        :param content: Text of the message
+        :param guild: Server the message was sent in
+        :param author: Member who sent the message
+        :param channel: Channel the message was sent in
+        :param mentions: Members mentioned in the message
+        :param role_mentions: Roles mentioned in the message
+        """
+        self.content = content
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.mentions = list(mentions)
+        self.role_mentions = list(role_mentions)
+
+
+@contextmanager
+def temporary_data_directory():
+    """
+    Run the with block from the src folder of a temporary copy of the data folder, so the real credits are never
+    touched
+    """
+    source_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as data_directory:
+        os.mkdir(os.path.join(data_directory, 'src'))
+        os.mkdir(os.path.join(data_directory, 'extra_files'))
+        shutil.copy('../extra_files/cour.ttf', os.path.join(data_directory, 'extra_files'))
+        os.chdir(os.path.join(data_directory, 'src'))
+        try:
+            yield
+        finally:
+            os.chdir(source_directory)
@@ -0,0 +1,257 @@
+"""
+Keep the credits of every server apart, each with its own files, in-memory credits, rank index and writer
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from credit_store import create_credit_store
+from credit_store import WriteBehind
+from rank_index import RankIndex
+from command_context import UserLocks
+from citizen import Citizen
+from rank_tiers import RankTiers
+from rank_tiers import load_class_roles
+from credit_history import CreditHistory
+from metrics import metrics
+
+load_dotenv()
+
+
+def adopt_legacy_credit_data(guild_id: int, guild_count: int = 1, data_directory: str = '../extra_files'):
+    """
+    Rename the credit data from before it was split by server to the files of the given server
+
+    Only the server in LEGACY_GUILD_ID adopts the old data. Without it, the old data is only adopted while the bot is
+    in a single server, as there is no telling which of several servers it belongs to. Nothing is renamed if the
+    server already has data of its own.
+
+    :param guild_id: ID of the server being loaded
+    :param guild_count: Number of servers the bot is in
+    :param data_directory: Folder the credit data is kept in
+    """
+    extensions = ['.json', '.log', '.log.1', '.db']
+    legacy_files = [os.path.join(data_directory, f'credit_data{extension}') for extension in extensions]
+    guild_files = [os.path.join(data_directory, f'credit_data_{guild_id}{extension}') for extension in extensions]
+    if not any(os.path.isfile(legacy_file) for legacy_file in legacy_files):
+        return
+
+    legacy_guild_id = os.getenv('LEGACY_GUILD_ID')
+    if legacy_guild_id and int(legacy_guild_id) != guild_id:
+        return
+    if not legacy_guild_id and guild_count > 1:
+        print(f'Not giving the credit data from before it was split by server to server {guild_id}, the bot is in '
+              f'{guild_count} servers so set LEGACY_GUILD_ID to the one it belongs to', file=sys.stderr)
+        return
+
+    if any(os.path.isfile(guild_file) for guild_file in guild_files):
+        return
+    for legacy_file, guild_file in zip(legacy_files, guild_files):
+        if os.path.isfile(legacy_file):
+            os.replace(legacy_file, guild_file)
+
+
+class GuildState:
+    """
+    Credits of a single server
+    """
+
+    def __init__(self, guild_id: int, executor: ThreadPoolExecutor = None, class_roles: list = None):
+        """
+        Credits of a single server
+
+        :param guild_id: ID of the server
+        :param executor: Executor shared by the writers of every server
+        :param class_roles: Classes to split the citizens into by rank, or None to not use classes
+        """
+        self.guild_id = guild_id
+        self.credits = {}
+        self.names = {}
+        self.credit_store = create_credit_store(guild_id)
+        self.credit_writer = WriteBehind(self.credit_store, executor=executor)
+        self.rank_index = RankIndex()
+        self.rank_tiers = RankTiers(class_roles) if class_roles else None
+        self.tier_changes = set()
+        self.credit_history = CreditHistory(f'../extra_files/credit_history_{guild_id}.bin')
+        self.credit_version = 0
+        self.user_locks = UserLocks()
+
+    def load(self):
+        """
+        Load the server's credits and build its rank index
+        """
+        self.credits = self.credit_store.load()
+        self.credit_history.load()
+        self.names = {citizen.name: user for user, citizen in self.credits.items()}
+        self.rank_index.build(self.credits)
+        if self.rank_tiers is not None:
+            self.tier_changes.update(self.rank_tiers.refresh(self.rank_index, ()))
+
+    def add_citizen(self, member: object):
+        """
+        Open an account for the member
+
+        :param member: Discord member to add
+        """
+        self.credits[member.id] = Citizen(member.id, member.name, member.display_name)
+        self.names[member.name] = member.id
+
+    def rename_citizen(self, citizen: object, name: str):
+        """
+        Change the citizen's name, keeping the name index current
+
+        :param citizen: Citizen to rename
+        :param name: New discord name of the citizen
+        """
+        if self.names.get(citizen.name) == citizen.id:
+            del self.names[citizen.name]
+        citizen.name = name
+        self.names[name] = citizen.id
+
+    def remove_citizen(self, user: int):
+        """
+        Close the citizen's account
+
+        :param user: ID of the citizen
+        """
+        citizen = self.credits.pop(user)
+        if self.names.get(citizen.name) == user:
+            del self.names[citizen.name]
+
+    def find_citizen(self, name: str):
+        """
+        Find a citizen by their discord name or display name
+
+        :param name: Name to look for, ignoring case for display names
+        :return: ID of the citizen, or None if nobody has the name
+        """
+        if name in self.names:
+            return self.names[name]
+        return next((user for user, citizen in self.credits.items()
+                     if citizen.display_name.lower() == name.lower()), None)
+
+    def save_credits(self, *users: int, reindex: bool = True):
+        """
+        Mark the given users as changed so the credit writer saves them in the background, move them to their
+        new position in the rank index and record their new credits in their history
+
+        :param users: IDs of the users whose credits changed
+        :param reindex: Boolean indicating if the rank index still needs updating for the users
+        """
+        with metrics.timer('save credits', 'mark'):
+            self.update_saved_users(users, reindex)
+
+    def update_saved_users(self, users: tuple, reindex: bool):
+        """
+        Update the rank index, classes, credit version, history and writer for the saved users
+
+        :param users: IDs of the users whose credits changed
+        :param reindex: Boolean indicating if the rank index still needs updating for the users
+        """
+        # Sorting everyone once is faster than moving a large share of the users one at a time
+        if reindex and len(users) > max(len(self.rank_index) // 8, 64):
+            self.rank_index.build(self.credits)
+        elif reindex:
+            for user in users:
+                if user in self.credits:
+                    self.rank_index.update(user, self.credits[user].credits)
+                else:
+                    self.rank_index.remove(user)
+
+        # Queue the role changes of everyone whose class changed
+        if self.rank_tiers is not None and users:
+            self.tier_changes.update(self.rank_tiers.refresh(self.rank_index, users))
+        if users:
+            self.credit_version += 1
+            timestamp = int(time.time())
+            for user in users:
+                if user in self.credits:
+                    self.credit_history.record(user, self.credits[user].credits, timestamp)
+                else:
+                    self.credit_history.remove(user)
+        self.credit_writer.mark(*users)
+
+
+class GuildStates:
+    """
+    Credits of every server, loaded the first time each server is used
+    """
+
+    def __init__(self, count_guilds=None):
+        """
+        Credits of every server, loaded the first time each server is used
+
+        :param count_guilds: Function returning the number of servers the bot is in, or None if it is only in one
+        """
+        self.guilds = {}
+        self.count_guilds = count_guilds
+        self.loop = None
+        self.class_roles = load_class_roles()
+        self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('CREDIT_WRITE_THREADS', 4)))
+        self.history_save_interval = float(os.getenv('HISTORY_SAVE_INTERVAL', 60))
+        self.history_task = None
+
+    def get(self, guild_id: int) -> GuildState:
+        """
+        Get the credits of the server, loading them if this is the first time the server is used
+
+        :param guild_id: ID of the server
+        :return: GuildState of the server
+        """
+        guild_state = self.guilds.get(guild_id)
+        if guild_state is None:
+            adopt_legacy_credit_data(guild_id, self.count_guilds() if self.count_guilds is not None else 1)
+            guild_state = GuildState(guild_id, self.executor, self.class_roles)
+            guild_state.load()
+            if self.loop is not None:
+                guild_state.credit_writer.start(self.loop)
+            self.guilds[guild_id] = guild_state
+        return guild_state
+
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        Start the background writers of every loaded server, and of any server loaded from now on
+
+        :param loop: Event loop the bot is running on
+        """
+        self.loop = loop
+        for guild_state in self.guilds.values():
+            guild_state.credit_writer.start(loop)
+        if self.history_task is None:
+            self.history_task = loop.create_task(self.save_histories())
+
+    async def save_histories(self):
+        """
+        Save the credit histories that changed every HISTORY_SAVE_INTERVAL seconds, so a crash loses at most that much
+        """
+        while True:
+            await asyncio.sleep(self.history_save_interval)
+            for guild_state in list(self.guilds.values()):
+                credit_history = guild_state.credit_history
+                if not credit_history.changed:
+                    continue
+
+                # Copied on the loop, as the history keeps changing while the file is written in the executor
+                data = credit_history.serialize()
+                try:
+                    await self.loop.run_in_executor(self.executor, credit_history.write, data)
+                except OSError as e:
+                    print(e, file=sys.stderr)
+                    credit_history.changed = True
+
+    def close(self):
+        """
+        Wait for the writes in progress, then write everything left, close every server's store and save the credit
+        histories
+        """
+        if self.history_task is not None:
+            self.history_task.cancel()
+            self.history_task = None
+        self.executor.shutdown(wait=True)
+        for guild_state in self.guilds.values():
+            guild_state.credit_writer.close()
+            guild_state.credit_history.save()
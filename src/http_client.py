@@ -0,0 +1,166 @@
+"""
+Shared asynchronous HTTP client for every outbound data fetch, reusing its connections and retrying failed requests
+
+Run from the src folder to check the retries against the stand-in Google Sheets API:
+    python http_client.py
+"""
+
+import os
+import random
+import asyncio
+import aiohttp
+
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+# Responses worth trying again, the server is busy or having a moment
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class HttpClient:
+    """
+    Pooled keep-alive session with a timeout, retries with exponential backoff and a limit on concurrent requests
+    """
+
+    def __init__(self, timeout: float = None, retries: int = None, backoff: float = None, max_connections: int = None,
+                 max_concurrent: int = None):
+        """
+        Pooled keep-alive session with a timeout, retries with exponential backoff and a limit on concurrent requests
+
+        :param timeout: Most seconds a request can take, defaults to HTTP_TIMEOUT or 10
+        :param retries: Times to retry a failed request, defaults to HTTP_RETRIES or 3
+        :param backoff: Seconds to wait before the first retry, doubling with each retry, defaults to HTTP_BACKOFF or
+                        0.5
+        :param max_connections: Most connections to keep open, defaults to HTTP_MAX_CONNECTIONS or 10
+        :param max_concurrent: Most requests in flight at once, defaults to HTTP_MAX_CONCURRENT or 4
+        """
+        self.timeout = timeout or float(os.getenv('HTTP_TIMEOUT', 10))
+        self.retries = retries if retries is not None else int(os.getenv('HTTP_RETRIES', 3))
+        self.backoff = backoff if backoff is not None else float(os.getenv('HTTP_BACKOFF', 0.5))
+        self.max_connections = max_connections or int(os.getenv('HTTP_MAX_CONNECTIONS', 10))
+        self.max_concurrent = max_concurrent or int(os.getenv('HTTP_MAX_CONCURRENT', 4))
+        self.session = None
+        self.slots = None
+        self.loop = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Get the session of the running event loop, creating it the first time or if the bot restarted on a new loop
+
+        :return: Session to make requests with
+        """
+        loop = asyncio.get_event_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+            self.loop = loop
+        return self.session
+
+    async def get_text(self, url: str, params: dict = None) -> str:
+        """
+        Get the body of the URL, retrying connection errors, timeouts and busy responses
+
+        :param url: URL to get
+        :param params: Query parameters to add to the URL
+        :return: Body of the response
+        """
+        session = self.get_session()
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                async with self.slots:
+                    async with session.get(url, params=params) as response:
+                        if response.status not in RETRY_STATUSES or attempt == self.retries:
+                            response.raise_for_status()
+                            return await response.text()
+                        retry_after = self.get_retry_after(response)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+
+            # Wait outside the concurrency limit so other requests can go ahead
+            metrics.increment('http retries')
+            await asyncio.sleep(retry_after if retry_after is not None
+                                else self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    @staticmethod
+    def get_retry_after(response: aiohttp.ClientResponse):
+        """
+        Get how long the server asked to wait before retrying
+
+        :param response: Response to retry
+        :return: Seconds to wait, or None if the server did not say
+        """
+        try:
+            return min(float(response.headers['Retry-After']), 60)
+        except (KeyError, ValueError):
+            return None
+
+    async def close(self):
+        """
+        Close the session and its connections
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+
+# Shared by every fetch so they all use the same connections
+http_client = HttpClient()
+
+
+if __name__ == '__main__':
+    # Check the retries, Retry-After and timeouts against the stand-in Google Sheets API, run from the src folder
+    import time
+    from sheets_stub import SheetsStub
+
+    async def check_retries():
+        """
+        Fail the stand-in in every way the client retries and check it gives up when it should
+        """
+        # A 503 on every other request is retried once and then succeeds
+        sheets_stub = SheetsStub(fail_every=2)
+        url = f'{sheets_stub.start()}/v4/spreadsheets/sheet/values/Prices'
+        client = HttpClient(timeout=1, retries=2, backoff=0.01)
+        await client.get_text(url)
+        await client.get_text(url)
+        assert sheets_stub.requests == 3, sheets_stub.requests
+
+        # A 503 on every request is tried once plus every retry, then raised
+        sheets_stub.fail_every, sheets_stub.requests = 1, 0
+        try:
+            await client.get_text(url)
+            raise AssertionError('a request failing every time did not raise')
+        except aiohttp.ClientResponseError as e:
+            assert e.status == 503, e.status
+        assert sheets_stub.requests == client.retries + 1, sheets_stub.requests
+
+        # The wait asked for by Retry-After is used instead of the backoff
+        sheets_stub.fail_every, sheets_stub.retry_after, sheets_stub.requests = 2, 0.5, 1
+        start_time = time.perf_counter()
+        await client.get_text(url)
+        assert time.perf_counter() - start_time >= 0.5, time.perf_counter() - start_time
+        assert sheets_stub.requests == 3, sheets_stub.requests
+
+        # Every attempt taking longer than the timeout gives up after the retries
+        sheets_stub.fail_every, sheets_stub.latency, sheets_stub.requests = 0, 0.5, 0
+        client.timeout = 0.1
+
+        # The timeout is given to the session when it is created
+        await client.close()
+        try:
+            await client.get_text(url)
+            raise AssertionError('a request timing out every time did not raise')
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            pass
+        assert sheets_stub.requests == client.retries + 1, sheets_stub.requests
+
+        await client.close()
+        sheets_stub.close()
+        print('Retries, Retry-After and timeouts all behave')
+
+    asyncio.get_event_loop().run_until_complete(check_retries())
@@ -2,15 +2,8 @@
 Handle all of the LCS betting logic for the Social Credit Bot
 """
 
-import bs4
 import sys
 import os
-from selenium import webdriver
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.common.by import By
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
 
 
 class LCSBetting:
@@ -19,6 +12,10 @@ class LCSBetting:
     """
 
     def __init__(self, league):
+        # Selenium is slow to import, so only load it once betting is actually used
+        from selenium import webdriver
+        from selenium.webdriver.firefox.firefox_binary import FirefoxBinary
+
         self.driver = None
         self.soup = None
         self.matchups = None
@@ -52,6 +49,11 @@ class LCSBetting:
         """
         Create a beautiful soup object
         """
+        import bs4
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.webdriver.common.by import By
+        from selenium.common.exceptions import TimeoutException
 
         # Wait until the schedule loads
         try:
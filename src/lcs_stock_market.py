@@ -2,14 +2,19 @@
 Interact with the stock market spreadsheet to play along with the LCS stock market game
 """
 
+import io
 import os
-import requests
 import json
 import time
+import asyncio
 import matplotlib.pyplot as plt
 
 from dotenv import load_dotenv
 from text_to_image import CreateImage
+from metrics import metrics
+from price_cache import PriceCache
+from http_client import http_client
+from credit_store import SqliteCreditStore
 
 load_dotenv()
 
@@ -24,25 +29,36 @@ class StockMarket:
         """
         self.stock_market_values = None
         self.api_key = f'?key={os.getenv("SHEETS_API_KEY")}'
-        self.api_base_url = 'https://sheets.googleapis.com'
+        self.api_base_url = os.getenv('SHEETS_API_BASE_URL', 'https://sheets.googleapis.com')
         self.sheet_values_query = '/v4/spreadsheets/1y3rMtxTl8h-KtJJdI1x2Yy3TY02lGvdB4bBGteIh5Ao/values/Prices'
         self.not_found_teams = []
         self.sheet_info = None
+        self.version = None
         self.rows = []
         self.row_colours = []
 
-    def get_stock_market_information(self):
+    async def get_stock_market_information(self):
         """
         Setup the stock information
         """
-        self.query_stock_information_sheet()
+        await self.query_stock_information_sheet()
         self.format_stock_market_values()
 
-    def query_stock_information_sheet(self):
+    def use_prices(self, prices: tuple):
+        """
+        Use prices that were already fetched and formatted instead of querying the sheet
+
+        :param prices: Tuple of the version and the formatted values from fetch_stock_market_prices()
+        """
+        self.version, self.stock_market_values = prices
+
+    async def query_stock_information_sheet(self):
         """
         Query the sheet to grab the information
         """
-        self.sheet_info = requests.get(f'{self.api_base_url}{self.sheet_values_query}{self.api_key}').text
+        with metrics.timer('sheets fetch'):
+            self.sheet_info = await http_client.get_text(f'{self.api_base_url}{self.sheet_values_query}{self.api_key}')
+        self.version = hash(self.sheet_info)
         self.stock_market_values = json.loads(self.sheet_info)['values'][1:]
 
     def format_stock_market_values(self):
@@ -130,33 +146,37 @@ class StockMarket:
         y = self.stock_market_values[team]
         plt.plot(x, y, label=team)
 
-    def display_stock_market_graph(self, debug=False):
+    def display_stock_market_graph(self, debug=False) -> bytes:
         """
         Add the legend to the graph and display it
 
         :param debug: If debug is on it will show the graph
-        """
-        plt.xticks([day_cnt for day_cnt in range(len(self.stock_market_values['TL']))])
-        plt.title('LCS Stock Market Values')
-        plt.xlabel('Game')
-        plt.ylabel('Value')
-        plt.legend(loc='upper left', ncol=2)
-        plt.savefig('../extra_files/stock_market_line_graph.png')
+        :return: PNG of the graph
+        """
+        with metrics.timer('matplotlib render', 'stock market'):
+            plt.xticks([day_cnt for day_cnt in range(len(self.stock_market_values['TL']))])
+            plt.title('LCS Stock Market Values')
+            plt.xlabel('Game')
+            plt.ylabel('Value')
+            plt.legend(loc='upper left', ncol=2)
+            image = io.BytesIO()
+            plt.savefig(image, format='png')
         plt.clf()
         if debug:
             plt.show()
+        return image.getvalue()
 
-    def display_stock_market_table(self, teams: list = False):
+    def display_stock_market_table(self, teams: list = False) -> bytes:
         """
         Create a table to show the values of each team in the stock market
 
         :param teams: List of specific teams to make the table out of
+        :return: PNG of the table
         """
         titles = ['Team', 'Value', 'Last Week', 'Min', 'Max', 'Avg']
-        file_name = '../extra_files/stock_market_table.png'
 
         self.get_all_team_rows(teams)
-        CreateImage(titles, self.rows, file_name, colour=self.row_colours)
+        return CreateImage(titles, self.rows, colour=self.row_colours).image
 
     def get_all_team_rows(self, teams: list = False):
         """
@@ -202,6 +222,21 @@ class StockMarket:
             self.row_colours.append(['', '', 'red', '', '', ''])
 
 
+async def fetch_stock_market_prices() -> tuple:
+    """
+    Query the sheet and format the prices for the price cache
+
+    :return: Tuple of the version and the formatted values, which are shared and must not be changed
+    """
+    stock_market = StockMarket()
+    await stock_market.get_stock_market_information()
+    return stock_market.version, stock_market.stock_market_values
+
+
+# Prices shared by every stock market command
+price_cache = PriceCache(fetch_stock_market_prices)
+
+
 class StockMarketBotCommands:
     """
     Handle the discord commands for the stock market
@@ -209,12 +244,32 @@ class StockMarketBotCommands:
     # Todo
     #   -   Create table showing gains/losses in green/red
     #   -   Weekly schedule
-    def __init__(self, social_credit_bot: object):
+
+    # Method to run for each command, the router has already resolved the aliases
+    command_options = {
+        'team': 'process_individual_team_graphs',
+        'league': 'process_league_graph',
+        'buy': 'buy_or_sell_stock',
+        'sell': 'buy_or_sell_stock',
+        'status': 'player_status',
+        'help': 'help_message',
+        'leaderboard': 'leader_board'
+    }
+
+    def __init__(self, social_credit_bot: object, ctx: object):
+        """
+        Handle the discord commands for the stock market
+
+        :param social_credit_bot: Social credit bot holding everyone's credits
+        :param ctx: Context of the command being handled
+        """
         self.social_credit_bot = social_credit_bot
-        self.message = social_credit_bot.message
-        self.credits = social_credit_bot.credits
+        self.ctx = ctx
+        self.message = ctx.message
+        self.guild_state = ctx.guild_state
+        self.credits = ctx.credits
         self.stock_market = StockMarket()
-        self.command = None
+        self.command = ctx.command.action
         self.user_stock_market_credits = None
         self.team = None
         self.amount = None
@@ -222,85 +277,95 @@ class StockMarketBotCommands:
         self.total_worth = None
         self.team_stocks = None
         self.image_description = ''
-        self.command_options = {
-            'teams': self.process_individual_team_graphs,
-            'team': self.process_individual_team_graphs,
-            'league': self.process_league_graph,
-            'lcs': self.process_league_graph,
-            'buy': self.buy_or_sell_stock,
-            'purchase': self.buy_or_sell_stock,
-            'sell': self.buy_or_sell_stock,
-            'status': self.player_status,
-            'help': self.help_message,
-            'leaderboard': self.leader_board
-        }
-
-    def setup(self):
+        self.images = []
+
+    async def setup(self):
         """
         Setup the stock market object to run the given commands on
         """
-        self.stock_market.get_stock_market_information()
-        if 'stock_market' not in self.credits[self.message.author.name]:
-            self.credits[self.message.author.name]['stock_market'] = {'money': 5000}
-            for team in self.stock_market.stock_market_values.keys():
-                self.credits[self.message.author.name]['stock_market'][team] = 0
-            self.social_credit_bot.save_credits()
-        self.user_stock_market_credits = self.credits[self.message.author.name]['stock_market']
+        self.stock_market.use_prices(await price_cache.get())
+
+    def open_account(self):
+        """
+        Give the user their starting money the first time they play, run while holding the user's lock
+        """
+        citizen = self.credits[self.ctx.user]
+        if citizen.stock_market is None:
+            citizen.stock_market = {'money': 5000}
+            self.guild_state.save_credits(self.ctx.user)
+        self.user_stock_market_credits = citizen.stock_market
+
+    def get_cache_key(self):
+        """
+        Get the key to cache the result of a read-only command under
+
+        :return: Tuple of the command, normalized arguments and data versions, or None if the command changes data
+        """
+        if self.ctx.command.error:
+            return None
+        elif self.command in [None, 'league']:
+            return 'stocks league', self.stock_market.version
+        elif self.command == 'team':
+            return 'stocks team', tuple(sorted(set(self.ctx.command.teams))), self.stock_market.version
+        elif self.command == 'leaderboard':
+            return 'stocks leaderboard', self.stock_market.version, self.guild_state.guild_id, \
+                self.guild_state.credit_version
+        elif self.command == 'status':
+            return 'stocks status', self.ctx.user, self.stock_market.version, \
+                self.guild_state.guild_id, self.guild_state.credit_version
+        return None
+
+    def reads_written_credits(self) -> bool:
+        """
+        Check if the command reads the credits from the credit store rather than from memory, so the pending
+        changes have to be written first
+
+        :return: Boolean indicating if the credit writer should be flushed before running the command
+        """
+        return self.command == 'leaderboard' and isinstance(self.guild_state.credit_store, SqliteCreditStore)
 
     def parse_discord_message(self):
         """
         Parse the discord message to determine what the user wants to do
         """
-        if len(self.message.content.split()) > 1:
-            self.command = self.message.content.split()[1]
-            if self.command_options.get(self.command, False):
-                self.command_options[self.command]()
-            else:
-                self.status_message = f'Unknown command: {self.command}. Use the following command for help.\n' \
-                                      f'!stocks help'
+        if self.ctx.command.error:
+            self.status_message = self.ctx.command.error
+        elif self.command is not None:
+            getattr(self, self.command_options[self.command])()
         else:
-            self.command = self.message.content
             self.process_league_graph()
 
     def process_individual_team_graphs(self):
         """
         Create graphs for every team in the message
         """
-        teams = []
-        for team in self.message.content.split()[2:]:
-            self.stock_market.create_team_stock_value_graph(team.replace(',', '').strip().upper())
-            teams.append(team.replace(',', '').strip().upper())
-        self.stock_market.display_stock_market_graph()
-        self.stock_market.display_stock_market_table(teams)
+        teams = self.ctx.command.teams
+        for team in teams:
+            self.stock_market.create_team_stock_value_graph(team)
+        self.images.append(['stock_market_line_graph.png', self.stock_market.display_stock_market_graph()])
+        self.images.append(['stock_market_table.png', self.stock_market.display_stock_market_table(teams)])
 
     def process_league_graph(self):
         """
         Create a graph for the entire league
         """
         self.stock_market.create_stock_value_graph_for_league()
-        self.stock_market.display_stock_market_graph()
-        self.stock_market.display_stock_market_table()
+        self.images.append(['stock_market_line_graph.png', self.stock_market.display_stock_market_graph()])
+        self.images.append(['stock_market_table.png', self.stock_market.display_stock_market_table()])
 
     def buy_or_sell_stock(self):
         """
         Setup for the user to buy or sell stocks
         """
-        try:
-            self.team = self.message.content.split()[2].upper()
-            self.amount = int(self.message.content.split()[3])
-        except IndexError:
-            self.status_message = 'Not enough commands, see !stocks help for guidance.'
-        except ValueError:
-            self.status_message = 'Invalid number of stocks, see !stocks help for guidance.'
-
-        else:
-            if self.team not in self.stock_market.stock_market_values.keys():
-                self.stock_market.not_found_teams.append(self.team)
-            elif self.message.content.split()[1] == 'buy' or self.message.content.split()[1] == 'purchase':
-                self.buy_stocks()
-            elif self.message.content.split()[1] == 'sell':
-                self.sell_stocks()
-        self.social_credit_bot.save_credits()
+        self.team = self.ctx.command.team
+        self.amount = self.ctx.command.amount
+        if self.team not in self.stock_market.stock_market_values.keys():
+            self.stock_market.not_found_teams.append(self.team)
+        elif self.command == 'buy':
+            self.buy_stocks()
+        elif self.command == 'sell':
+            self.sell_stocks()
+        self.guild_state.save_credits(self.ctx.user)
 
     def buy_stocks(self):
         """
@@ -310,7 +375,8 @@ class StockMarketBotCommands:
             stock_requested_value = self.stock_market.stock_market_values[self.team][-1] * self.amount
             if stock_requested_value < self.user_stock_market_credits['money']:
                 self.user_stock_market_credits['money'] -= stock_requested_value
-                self.user_stock_market_credits[self.team] += self.amount
+                self.user_stock_market_credits[self.team] = self.user_stock_market_credits.get(self.team, 0) + \
+                    self.amount
                 self.status_message = f'Successfully purchased {self.amount} stocks of {self.team} for ' \
                                       f'{stock_requested_value}.\nYou have {self.user_stock_market_credits["money"]} ' \
                                       f'remaining.'
@@ -330,15 +396,19 @@ class StockMarketBotCommands:
         Have the user sell stocks
         """
         if self.verify_games_have_not_started():
-            if self.user_stock_market_credits[self.team] >= self.amount:
+            if self.user_stock_market_credits.get(self.team, 0) >= self.amount:
                 sell_value = self.stock_market.stock_market_values[self.team][-1] * self.amount
                 self.user_stock_market_credits['money'] += sell_value
                 self.user_stock_market_credits[self.team] -= self.amount
+
+                # Only keep the teams the user holds stocks of
+                if self.user_stock_market_credits[self.team] == 0:
+                    del self.user_stock_market_credits[self.team]
                 self.status_message = f'Successfully sold {self.amount} stocks of {self.team} for {sell_value}.\n' \
                                       f'You now have {self.user_stock_market_credits["money"]} remaining.'
             else:
                 self.status_message = f'You do not have {self.amount} stocks to sell. You only have ' \
-                                      f'{self.user_stock_market_credits[self.team]}.'
+                                      f'{self.user_stock_market_credits.get(self.team, 0)}.'
 
     def verify_games_have_not_started(self) -> bool:
         """
@@ -367,9 +437,9 @@ class StockMarketBotCommands:
         Set the status message as the player's overall worth
         """
         self.get_player_worth(self.user_stock_market_credits)
-        self.image_description = f'{self.social_credit_bot.display_name}\'s total worth table:'
-        CreateImage(['Team', 'Price', 'Amount', 'Total Value'], self.team_stocks,
-                    '../extra_files/stock_market_player_status.png')
+        self.image_description = f'{self.ctx.display_name}\'s total worth table:'
+        self.images.append(['stock_market_player_status.png',
+                            CreateImage(['Team', 'Price', 'Amount', 'Total Value'], self.team_stocks).image])
 
     def get_player_worth(self, player_stock_market: dict):
         """
@@ -430,8 +500,7 @@ class StockMarketBotCommands:
         """
         titles = ['Player', 'Worth']
         rows = self.get_every_players_worth()
-        file_name = '../extra_files/stock_market_leaderboard.png'
-        CreateImage(titles, rows, file_name)
+        self.images.append(['stock_market_leaderboard.png', CreateImage(titles, rows).image])
 
     def get_every_players_worth(self) -> list:
         """
@@ -439,16 +508,12 @@ class StockMarketBotCommands:
 
         :return: Dual array [[name, worth], [name, worth]...]
         """
-        all_rows = []
-        for user in self.social_credit_bot.credits:
-            if 'stock_market' in self.social_credit_bot.credits[user]:
-                self.get_player_worth(self.social_credit_bot.credits[user]['stock_market'])
-                all_rows.append([self.social_credit_bot.credits[user]['display name'].strip(), self.total_worth])
-        return all_rows
+        prices = {team: values[-1] for team, values in self.stock_market.stock_market_values.items()}
+        return self.guild_state.credit_store.stock_market_worth(prices)
 
 
 if __name__ == '__main__':
     stock_market = StockMarket()
-    stock_market.get_stock_market_information()
+    asyncio.get_event_loop().run_until_complete(stock_market.get_stock_market_information())
     stock_market.display_stock_market_table()
     print()
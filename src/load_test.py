@@ -0,0 +1,263 @@
+"""
+Replay a trace of commands through the bot's on_message, with stand-ins for discord and the Google Sheets API, and
+report the throughput and the latency from receiving each command to its replies being sent
+
+Run from the src folder:
+    python load_test.py --synthesize 2000 --rate 50          Replay a synthetic game day of 2,000 commands
+    python load_test.py --trace ../extra_files/trace.jsonl   Replay commands recorded with RECORD_TRACE
+    python load_test.py --trace trace.jsonl --speed 0        Replay as fast as the concurrency allows
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextvars
+
+from dotenv import load_dotenv
+from metrics import metrics, Timing
+from command_trace import read_trace, synthesize_trace
+from fake_discord import FakeMember, FakeRole, FakeGuild, FakeChannel, FakeMessage, temporary_data_directory
+from sheets_stub import SheetsStub
+from http_client import http_client
+
+load_dotenv()
+
+
+class TraceReplay:
+    """
+    Replay a trace through the bot, timing every command until its replies are sent
+    """
+
+    # Replies queued by the command being replayed in the current task
+    replies = contextvars.ContextVar('replies')
+
+    def __init__(self, commands: list, concurrency: int, speed: float, send_latency: float):
+        """
+        Replay a trace through the bot, timing every command until its replies are sent
+
+        :param commands: Commands from read_trace()
+        :param concurrency: Most commands being handled at once
+        :param speed: How many times faster than recorded to replay, or 0 to replay as fast as possible
+        :param send_latency: Seconds each message takes to send to discord
+        """
+        self.commands = commands
+        self.concurrency = concurrency
+        self.speed = speed
+        self.send_latency = send_latency
+        self.guilds = {}
+        self.channels = {}
+        self.members = {}
+        self.bot = None
+        self.on_message = None
+        self.handle_times = Timing(len(commands))
+        self.end_to_end_times = Timing(len(commands))
+        self.command_times = {}
+        self.replied = 0
+        self.seconds = 0
+
+    def create_servers(self):
+        """
+        Create every server, channel and member in the trace, and sync the members the way on_ready does
+        """
+        guild_members = {}
+        for command in self.commands:
+            users = [command['author']] + command['mentions'] + [user for role in command['role_mentions']
+                                                                  for user in role]
+            for user in users:
+                if user not in self.members:
+                    self.members[user] = FakeMember(user)
+                guild_members.setdefault(command['guild'], {})[user] = self.members[user]
+            self.members[command['author']].guild_permissions.administrator |= command['administrator']
+            if command['channel'] not in self.channels:
+                self.channels[command['channel']] = FakeChannel(command['channel'], self.send_latency)
+
+        for guild_id, members in guild_members.items():
+            self.guilds[guild_id] = FakeGuild(guild_id, list(members.values()))
+            self.bot.get_all_member_credit_information(self.guilds[guild_id])
+
+    def collect_replies(self):
+        """
+        Wrap the outbound queue so the replies of each command are collected in its task
+        """
+        queue_send = self.bot.outbound_queue.send
+
+        def send(channel: object, content: str = None, file: object = None) -> asyncio.Future:
+            sent = queue_send(channel, content, file)
+            replies = self.replies.get(None)
+            if replies is not None:
+                replies.append(sent)
+            return sent
+        self.bot.outbound_queue.send = send
+
+    def run(self):
+        """
+        Replay the trace in a temporary copy of the data folder, so the real credits are never touched
+        """
+        with temporary_data_directory():
+            from social_credit_bot import DiscordBot
+            self.bot = DiscordBot(start=False)
+            self.on_message = self.bot.bot.on_message
+            self.collect_replies()
+            loop = asyncio.get_event_loop()
+            self.bot.guild_states.start(loop)
+            self.create_servers()
+            loop.run_until_complete(self.replay())
+            loop.run_until_complete(http_client.close())
+            self.bot.guild_states.close()
+
+    async def replay(self):
+        """
+        Send every command at its time in the trace, never handling more than the concurrency at once
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        start_time = time.perf_counter()
+        for command in self.commands:
+            if self.speed > 0:
+                arrival_time = start_time + command['time'] / self.speed
+                await asyncio.sleep(max(arrival_time - time.perf_counter(), 0))
+            else:
+                arrival_time = time.perf_counter()
+
+            # Time from when the command arrives, so waiting for a free slot counts towards its latency
+            await slots.acquire()
+            tasks.append(asyncio.get_event_loop().create_task(self.replay_command(command, arrival_time, slots)))
+        await asyncio.gather(*tasks)
+        self.seconds = time.perf_counter() - start_time
+
+    async def replay_command(self, command: dict, arrival_time: float, slots: asyncio.Semaphore):
+        """
+        Handle a command and wait for its replies to be sent
+
+        :param command: Command from the trace
+        :param arrival_time: Time the command arrived at in the replay
+        :param slots: Semaphore limiting the commands being handled at once
+        """
+        guild = self.guilds[command['guild']]
+        message = FakeMessage(command['content'], guild, self.members[command['author']],
+                              self.channels[command['channel']],
+                              [self.members[user] for user in command['mentions']],
+                              [FakeRole([self.members[user] for user in role]) for role in command['role_mentions']])
+        replies = []
+        self.replies.set(replies)
+        try:
+            await self.on_message(message)
+            handled_time = time.perf_counter()
+            # A reply that failed to send was still answered as far as the latency goes
+            await asyncio.gather(*replies, return_exceptions=True)
+            end_time = time.perf_counter()
+        finally:
+            slots.release()
+
+        self.handle_times.observe(handled_time - arrival_time)
+        self.end_to_end_times.observe(end_time - arrival_time)
+        parsed = self.bot.command_router.parse(command['content'])
+        name = f'{parsed.group} {parsed.action or ""}'.strip() if parsed is not None else 'ignored'
+        self.command_times.setdefault(name, Timing(len(self.commands))).observe(end_time - arrival_time)
+        self.replied += bool(replies)
+
+    def report(self) -> dict:
+        """
+        Summarize the replay
+
+        :return: Dictionary of the throughput, latencies in milliseconds and counters
+        """
+        def percentiles(timing: Timing) -> dict:
+            return {'count': timing.count, 'p50': timing.percentile(0.5) * 1000,
+                    'p95': timing.percentile(0.95) * 1000, 'p99': timing.percentile(0.99) * 1000}
+
+        sheets_fetches = sum(timing.count for (name, _), timing in metrics.timings.items() if name == 'sheets fetch')
+        return {
+            'commands': len(self.commands),
+            'seconds': self.seconds,
+            'commands per second': len(self.commands) / self.seconds if self.seconds else 0,
+            'replied commands': self.replied,
+            'throttled commands': metrics.counters.get(('throttled commands', ''), 0),
+            'merged commands': metrics.counters.get(('merged commands', ''), 0),
+            'messages sent': sum(channel.messages for channel in self.channels.values()),
+            'sheets fetches': sheets_fetches,
+            'handle': percentiles(self.handle_times),
+            'end to end': percentiles(self.end_to_end_times),
+            'by command': {name: percentiles(timing) for name, timing in sorted(self.command_times.items())}
+        }
+
+
+def print_report(report: dict):
+    """
+    Print the summary of a replay
+
+    :param report: Summary from TraceReplay.report()
+    """
+    print(f'{report["commands"]:,} commands in {report["seconds"]:.1f} s, '
+          f'{report["commands per second"]:.1f} commands a second')
+    print(f'{report["replied commands"]:,} replied, {report["throttled commands"]:,} throttled, '
+          f'{report["merged commands"]:,} merged, {report["messages sent"]:,} messages sent, '
+          f'{report["sheets fetches"]:,} sheets fetches\n')
+    print(f'{"Latency ms":<28}{"count":>8}{"p50":>10}{"p95":>10}{"p99":>10}')
+    rows = [['handle', report['handle']], ['end to end', report['end to end']]]
+    rows += [[f'  {name}', timing] for name, timing in report['by command'].items()]
+    for name, timing in rows:
+        print(f'{name:<28}{timing["count"]:>8}{timing["p50"]:>10.1f}{timing["p95"]:>10.1f}{timing["p99"]:>10.1f}')
+
+
+def main():
+    """
+    Replay a recorded or synthetic trace and print the report
+    """
+    parser = argparse.ArgumentParser(description='Replay a trace of commands through the bot')
+    parser.add_argument('--trace', help='JSONL trace to replay, recorded by setting RECORD_TRACE')
+    parser.add_argument('--synthesize', type=int, metavar='COMMANDS',
+                        help='replay a synthetic trace of this many commands instead')
+    parser.add_argument('--rate', type=float, default=20, help='average commands a second of the synthetic trace')
+    parser.add_argument('--members', type=int, default=1000, help='members of each server of the synthetic trace')
+    parser.add_argument('--guilds', type=int, default=1, help='servers of the synthetic trace')
+    parser.add_argument('--channels', type=int, default=4, help='channels of each server of the synthetic trace')
+    parser.add_argument('--concurrency', type=int, default=64, help='most commands being handled at once')
+    parser.add_argument('--speed', type=float, default=1, help='times faster than recorded to replay, 0 for as fast '
+                                                               'as possible')
+    parser.add_argument('--send-latency', type=float, default=0.1, help='seconds discord takes to send a message')
+    parser.add_argument('--sheets-latency', type=float, default=0.2,
+                        help='seconds the stand-in Google Sheets API takes to answer')
+    parser.add_argument('--no-throttle', action='store_true', help='turn off the per user and channel limits')
+    parser.add_argument('--report', help='JSON file to write the report to')
+    arguments = parser.parse_args()
+
+    if arguments.trace:
+        commands = read_trace(arguments.trace)
+    elif arguments.synthesize:
+        trace_file = os.path.join(tempfile.gettempdir(), 'synthetic_trace.jsonl')
+        synthesize_trace(trace_file, arguments.synthesize, arguments.rate, arguments.guilds, arguments.channels,
+                         arguments.members)
+        commands = read_trace(trace_file)
+    else:
+        parser.error('give a --trace to replay or a number of commands to --synthesize')
+        return
+    report_file = os.path.abspath(arguments.report) if arguments.report else None
+
+    # Point the bot at the stand-ins before it reads its settings
+    sheets_stub = SheetsStub(arguments.sheets_latency)
+    os.environ['SHEETS_API_BASE_URL'] = sheets_stub.start()
+    os.environ.pop('RECORD_TRACE', None)
+    if arguments.no_throttle:
+        for setting in ['THROTTLE_USER_RATE', 'THROTTLE_USER_BURST', 'THROTTLE_CHANNEL_RATE', 'THROTTLE_CHANNEL_BURST']:
+            os.environ[setting] = '1000000000'
+
+    replay = TraceReplay(commands, arguments.concurrency, arguments.speed, arguments.send_latency)
+    try:
+        replay.run()
+    finally:
+        sheets_stub.close()
+    report = replay.report()
+    print_report(report)
+    if report_file:
+        with open(report_file, 'w') as file:
+            json.dump(report, file, indent=4)
+        print(f'\nSaved the report to {report_file}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
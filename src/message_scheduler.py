@@ -0,0 +1,152 @@
+"""
+Send delayed and recurring sequences of messages without blocking the bot, and resume them after a restart
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+
+from discord.errors import HTTPException
+
+
+class MessageScheduler:
+    """
+    Schedule sequences of messages to be sent to a channel
+    """
+
+    def __init__(self, bot: object, jobs_file: str = '../extra_files/scheduled_messages.json'):
+        """
+        Schedule sequences of messages to be sent to a channel
+
+        :param bot: Discord bot to send the messages with
+        :param jobs_file: JSON file the pending jobs are kept in
+        """
+        self.bot = bot
+        self.jobs_file = jobs_file
+        self.tasks = {}
+        self.save_lock = None
+
+        # Loaded right away so a job scheduled before the bot is ready cannot overwrite the saved ones
+        try:
+            with open(self.jobs_file, 'r', encoding='utf-8') as jobs_file:
+                self.jobs = {job['id']: job for job in json.load(jobs_file)}
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.jobs = {}
+
+    def start(self):
+        """
+        Start running the pending jobs saved by the last run of the bot
+        """
+        for job_id in self.jobs:
+            if job_id not in self.tasks:
+                self.tasks[job_id] = asyncio.get_event_loop().create_task(self.run_job(job_id))
+
+    async def schedule(self, channel_id: int, messages: list, delay: float = 0, interval: float = 0,
+                       repeat: float = None) -> str:
+        """
+        Schedule a sequence of messages
+
+        :param channel_id: ID of the channel to send the messages to
+        :param messages: Messages to send, in order
+        :param delay: Seconds to wait before sending the first message
+        :param interval: Seconds to wait between each message
+        :param repeat: Seconds between the start of each repeat of the sequence, or None to only send it once
+        :return: ID of the job
+        """
+        job_id = uuid.uuid4().hex
+        self.jobs[job_id] = {'id': job_id,
+                             'channel': channel_id,
+                             'messages': messages,
+                             'interval': interval,
+                             'repeat': repeat,
+                             'start': time.time() + delay,
+                             'position': 0}
+        await self.save_jobs()
+        self.tasks[job_id] = asyncio.get_event_loop().create_task(self.run_job(job_id))
+        return job_id
+
+    async def cancel(self, job_id: str):
+        """
+        Stop and remove a job
+
+        :param job_id: ID of the job
+        """
+        task = self.tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+        if self.jobs.pop(job_id, None) is not None:
+            await self.save_jobs()
+
+    async def run_job(self, job_id: str):
+        """
+        Send each message of the job when it is due, saving the progress after each one
+
+        :param job_id: ID of the job
+        """
+        job = self.jobs[job_id]
+        channel = None
+        while channel is None:
+            try:
+                channel = self.bot.get_channel(job['channel']) or await self.bot.fetch_channel(job['channel'])
+
+            # Drop the job if the channel is gone or the bot can no longer see it
+            except HTTPException as e:
+                print(e, file=sys.stderr)
+                job['position'] = len(job['messages'])
+                job['repeat'] = None
+                break
+
+            # Try again later if discord could not be reached
+            except Exception as e:
+                print(e, file=sys.stderr)
+                await asyncio.sleep(60)
+
+        while job['position'] < len(job['messages']):
+            due = job['start'] + job['position'] * job['interval']
+            await asyncio.sleep(max(due - time.time(), 0))
+
+            # A message that fails to send, from discord or the connection, is skipped and the schedule carries on
+            try:
+                await channel.send(job['messages'][job['position']])
+            except Exception as e:
+                print(e, file=sys.stderr)
+            job['position'] += 1
+
+            # Start the sequence again, skipping any repeats missed while the bot was down
+            if job['position'] == len(job['messages']) and job['repeat'] is not None:
+                job['position'] = 0
+                job['start'] += job['repeat']
+                if job['start'] < time.time():
+                    job['start'] += ((time.time() - job['start']) // job['repeat'] + 1) * job['repeat']
+            if job['position'] < len(job['messages']):
+                await self.save_jobs()
+
+        self.tasks.pop(job_id, None)
+        self.jobs.pop(job_id, None)
+        await self.save_jobs()
+
+    async def save_jobs(self):
+        """
+        Atomically write the pending jobs to the jobs file in the executor
+        """
+        jobs = json.dumps(list(self.jobs.values()), indent=4)
+
+        # Created on first use, as commands can schedule jobs before the bot is ready
+        if self.save_lock is None:
+            self.save_lock = asyncio.Lock()
+        async with self.save_lock:
+            await asyncio.get_event_loop().run_in_executor(None, self.write_jobs, jobs)
+
+    def write_jobs(self, jobs: str):
+        """
+        Replace the jobs file with the given jobs
+
+        :param jobs: Serialized jobs to write
+        """
+        temporary_file = f'{self.jobs_file}.tmp'
+        with open(temporary_file, 'w', encoding='utf-8') as jobs_file:
+            jobs_file.write(jobs)
+        os.replace(temporary_file, self.jobs_file)
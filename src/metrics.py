@@ -0,0 +1,196 @@
+"""
+Timings and counters for every part of the bot, shown by !ussr stats and optionally served for Prometheus
+"""
+
+import os
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class Timing:
+    """
+    Count and total of a timing, and its most recent samples for the percentiles
+    """
+
+    __slots__ = ['count', 'total', 'samples']
+
+    def __init__(self, sample_size: int):
+        """
+        Count and total of a timing, and its most recent samples for the percentiles
+
+        :param sample_size: Most recent samples to keep
+        """
+        self.count = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=sample_size)
+
+    def observe(self, seconds: float):
+        """
+        Add a sample
+
+        :param seconds: Time taken
+        """
+        self.count += 1
+        self.total += seconds
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Get a percentile of the recent samples
+
+        :param fraction: Percentile to get between 0 and 1, such as 0.95
+        :return: Seconds at the percentile
+        """
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+class Metrics:
+    """
+    Every timing and counter of the bot, each with an optional label
+    """
+
+    percentiles = [0.5, 0.95, 0.99]
+
+    def __init__(self, sample_size: int = None):
+        """
+        Every timing and counter of the bot, each with an optional label
+
+        :param sample_size: Recent samples to keep for each timing, defaults to METRICS_SAMPLE_SIZE or 1024
+        """
+        self.sample_size = sample_size or int(os.getenv('METRICS_SAMPLE_SIZE', 1024))
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name: str, seconds: float, label: str = ''):
+        """
+        Record how long something took
+
+        :param name: Name of the timing
+        :param seconds: Time taken
+        :param label: What is being timed within the name, such as the command
+        """
+        timing = self.timings.get((name, label))
+        if timing is None:
+            timing = self.timings[(name, label)] = Timing(self.sample_size)
+        timing.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, label: str = ''):
+        """
+        Time the with block
+
+        :param name: Name of the timing
+        :param label: What is being timed within the name, such as the command
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, label)
+
+    def increment(self, name: str, amount: int = 1, label: str = ''):
+        """
+        Add to a counter
+
+        :param name: Name of the counter
+        :param amount: Amount to add
+        :param label: What is being counted within the name
+        """
+        self.counters[(name, label)] = self.counters.get((name, label), 0) + amount
+
+    def register_gauge(self, name: str, read):
+        """
+        Register a value that is read whenever the metrics are shown
+
+        :param name: Name of the gauge
+        :param read: Function returning the current value
+        """
+        self.gauges[name] = read
+
+    def summary(self) -> str:
+        """
+        Summarize every timing and counter as text
+
+        :return: Table of the timings in milliseconds, then the counters and gauges
+        """
+        lines = [f'{"Timing":<40}{"count":>8}{"p50":>9}{"p95":>9}{"p99":>9}']
+        for (name, label), timing in sorted(self.timings.items()):
+            percentiles = ''.join(f'{timing.percentile(fraction) * 1000:>9.1f}' for fraction in self.percentiles)
+            lines.append(f'{f"{name} {label}".strip()[:39]:<40}{timing.count:>8}{percentiles}')
+        lines.append('')
+        for (name, label), value in sorted(self.counters.items()):
+            lines.append(f'{f"{name} {label}".strip()[:39]:<40}{value:>8}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'{name[:39]:<40}{read():>8}')
+        return '\n'.join(lines)
+
+    def prometheus(self) -> str:
+        """
+        Format every timing and counter in the Prometheus text format
+
+        :return: Prometheus metrics
+        """
+        lines = []
+        for (name, label), timing in sorted(self.timings.items()):
+            metric = f'social_credit_{self.metric_name(name)}_seconds'
+            for fraction in self.percentiles:
+                lines.append(f'{metric}{self.labels(label, fraction)} {timing.percentile(fraction)}')
+            lines.append(f'{metric}_count{self.labels(label)} {timing.count}')
+            lines.append(f'{metric}_sum{self.labels(label)} {timing.total}')
+        for (name, label), value in sorted(self.counters.items()):
+            lines.append(f'social_credit_{self.metric_name(name)}_total{self.labels(label)} {value}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'social_credit_{self.metric_name(name)} {read()}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def labels(label: str, quantile: float = None) -> str:
+        """
+        Format the labels of a Prometheus sample
+
+        :param label: Label of the timing or counter, or an empty string for none
+        :param quantile: Quantile of the sample, or None if it is not a quantile
+        :return: Labels in curly braces, or an empty string if there are none
+        """
+        labels = ([f'label="{label}"'] if label else []) + ([f'quantile="{quantile}"'] if quantile is not None else [])
+        return f'{{{",".join(labels)}}}' if labels else ''
+
+    @staticmethod
+    def metric_name(name: str) -> str:
+        """
+        Turn a name into a valid Prometheus metric name
+
+        :param name: Name of the timing or counter
+        :return: Name with only letters, digits and underscores
+        """
+        return ''.join(character if character.isalnum() else '_' for character in name.lower())
+
+    async def start_exporter(self, port: int):
+        """
+        Serve the metrics in the Prometheus text format on localhost
+
+        :param port: Port to serve the metrics on
+        """
+        from aiohttp import web
+
+        async def handle_metrics(_):
+            return web.Response(text=self.prometheus(), content_type='text/plain')
+
+        application = web.Application()
+        application.router.add_get('/metrics', handle_metrics)
+        runner = web.AppRunner(application)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+
+
+# Shared by every module so anything can be timed without passing the metrics around
+metrics = Metrics()
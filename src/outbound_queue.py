@@ -0,0 +1,139 @@
+"""
+Send the bot's messages through a queue for each channel, merging what is sent close together into fewer messages
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+from collections import deque
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+# Limits discord puts on a single message
+MAX_MESSAGE_LENGTH = 2000
+MAX_MESSAGE_FILES = 10
+
+
+class OutboundQueue:
+    """
+    Queue of messages for every channel, each sent by its own task so a slow channel never holds up the others
+    """
+
+    def __init__(self, coalesce_delay: float = None, messages_per_period: int = None, period: float = None):
+        """
+        Queue of messages for every channel, each sent by its own task so a slow channel never holds up the others
+
+        :param coalesce_delay: Seconds to wait for more messages before sending, defaults to OUTBOUND_COALESCE_DELAY or
+                               0.05
+        :param messages_per_period: Most messages to send to a channel each period, defaults to
+                                    OUTBOUND_MESSAGES_PER_PERIOD or 5
+        :param period: Length of the rate limit period in seconds, defaults to OUTBOUND_PERIOD or 5
+        """
+        self.coalesce_delay = coalesce_delay if coalesce_delay is not None \
+            else float(os.getenv('OUTBOUND_COALESCE_DELAY', 0.05))
+        self.messages_per_period = messages_per_period or int(os.getenv('OUTBOUND_MESSAGES_PER_PERIOD', 5))
+        self.period = period or float(os.getenv('OUTBOUND_PERIOD', 5))
+        self.pending = {}
+        self.workers = {}
+        self.sent_times = {}
+
+    def send(self, channel: object, content: str = None, file: object = None) -> asyncio.Future:
+        """
+        Queue a message for the channel without waiting for it to be sent
+
+        :param channel: Discord channel to send the message to
+        :param content: Text of the message
+        :param file: Discord file to attach to the message
+        :return: Future that is done once the message has been sent, or failed to, which nothing needs to wait for
+        """
+        loop = asyncio.get_event_loop()
+        sent = loop.create_future()
+        self.pending.setdefault(channel.id, deque()).append([content, file, sent])
+        metrics.increment('outbound replies')
+        if channel.id not in self.workers:
+            self.workers[channel.id] = loop.create_task(self.run(channel))
+        return sent
+
+    async def run(self, channel: object):
+        """
+        Send the channel's queued messages until there are none left
+
+        :param channel: Discord channel to send the messages to
+        """
+        try:
+            while self.pending.get(channel.id):
+                await asyncio.sleep(self.coalesce_delay)
+                items = self.pending.pop(channel.id)
+                for content, files, sent_futures in self.coalesce(items):
+                    await self.wait_for_rate_limit(channel.id)
+
+                    # Any failure, from discord or the connection, only loses this message and not the rest of the queue
+                    try:
+                        with metrics.timer('outbound send'):
+                            await channel.send(content or None, files=files or None)
+                        metrics.increment('outbound messages')
+                        error = None
+                    except Exception as e:
+                        print(e, file=sys.stderr)
+                        metrics.increment('outbound errors')
+                        error = e
+
+                    # Every queued item merged into the message is sent, or failed, along with it
+                    for sent in sent_futures:
+                        if error is None:
+                            sent.set_result(None)
+                        else:
+                            sent.set_exception(error)
+
+                            # Already logged, so a future nobody waits on should not log it again
+                            sent.exception()
+        finally:
+            del self.workers[channel.id]
+
+            # Forget the channels that have been quiet for a whole period
+            for quiet_channel in [quiet_channel for quiet_channel, sent_times in self.sent_times.items()
+                                  if sent_times[-1] + self.period < time.monotonic()]:
+                del self.sent_times[quiet_channel]
+
+    @staticmethod
+    def coalesce(items: deque) -> list:
+        """
+        Merge the queued messages in order, joining text up to the length limit and sending files with the same
+        description, or with none, together
+
+        :param items: Queued [content, file, sent] items
+        :return: List of [content, files, sent futures] messages to send
+        """
+        messages = []
+        for content, file, sent in items:
+            content = content or ''
+            last_message = messages[-1] if messages else None
+            if file is None:
+                if last_message is not None and not last_message[1] \
+                        and len(last_message[0]) + len(content) + 1 <= MAX_MESSAGE_LENGTH:
+                    last_message[0] = f'{last_message[0]}\n{content}'
+                    last_message[2].append(sent)
+                else:
+                    messages.append([content, [], [sent]])
+            elif last_message is not None and len(last_message[1]) < MAX_MESSAGE_FILES \
+                    and (content == '' or (last_message[1] and content == last_message[0])):
+                last_message[1].append(file)
+                last_message[2].append(sent)
+            else:
+                messages.append([content, [file], [sent]])
+        return messages
+
+    async def wait_for_rate_limit(self, channel_id: int):
+        """
+        Wait until another message can be sent to the channel without going over its rate limit
+
+        :param channel_id: ID of the channel
+        """
+        sent_times = self.sent_times.setdefault(channel_id, deque(maxlen=self.messages_per_period))
+        if len(sent_times) == self.messages_per_period:
+            await asyncio.sleep(max(sent_times[0] + self.period - time.monotonic(), 0))
+        sent_times.append(time.monotonic())
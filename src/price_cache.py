@@ -0,0 +1,98 @@
+"""
+Keep the stock market prices in memory, refreshing them in the background so commands rarely wait on Google Sheets
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+
+class PriceCache:
+    """
+    Prices shared by every command, fresh for a while, then served stale while a single refresh runs in the background
+
+    Prices only change a few times a week, so a command only waits for the fetch if there are no prices yet or they
+    are older than the maximum staleness. Every command arriving while a fetch runs waits on that same fetch.
+    """
+
+    def __init__(self, fetch, ttl: float = None, max_stale: float = None, retry_delay: float = None):
+        """
+        Prices shared by every command, fresh for a while, then served stale while a single refresh runs in the
+        background
+
+        :param fetch: Coroutine function returning the prices
+        :param ttl: Seconds the prices are fresh for, defaults to PRICE_CACHE_TTL or 300
+        :param max_stale: Most seconds old prices can be served while refreshing, defaults to PRICE_CACHE_MAX_STALE or
+                          86400
+        :param retry_delay: Seconds to wait after a failed refresh before trying again, defaults to
+                            PRICE_CACHE_RETRY_DELAY or 30
+        """
+        self.fetch = fetch
+        self.ttl = ttl if ttl is not None else float(os.getenv('PRICE_CACHE_TTL', 300))
+        self.max_stale = max_stale if max_stale is not None else float(os.getenv('PRICE_CACHE_MAX_STALE', 86400))
+        self.retry_delay = retry_delay if retry_delay is not None else float(os.getenv('PRICE_CACHE_RETRY_DELAY', 30))
+        self.prices = None
+        self.fetched_time = 0
+        self.retry_time = 0
+        self.refresh_task = None
+
+    async def get(self):
+        """
+        Get the prices, waiting for them only if there are none or they are too old to serve
+
+        :return: Prices returned by the fetch function
+        """
+        now = time.monotonic()
+        age = now - self.fetched_time
+        if self.prices is not None and age < self.ttl:
+            metrics.increment('price cache', label='fresh')
+            return self.prices
+
+        # Start a single refresh, unless the last one failed too recently
+        if self.refresh_task is None and (self.prices is None or now >= self.retry_time):
+            self.refresh_task = asyncio.get_event_loop().create_task(self.refresh())
+
+        if self.prices is not None and age < self.max_stale:
+            metrics.increment('price cache', label='stale')
+            return self.prices
+
+        # Shielded so a command giving up does not cancel the fetch the others are waiting on
+        metrics.increment('price cache', label='miss')
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.get_event_loop().create_task(self.refresh())
+        return await asyncio.shield(self.refresh_task)
+
+    async def refresh(self):
+        """
+        Fetch the prices and replace the cached ones
+
+        :return: New prices, or the old prices if the fetch failed and there are some
+        """
+        try:
+            prices = await self.fetch()
+            self.prices, self.fetched_time = prices, time.monotonic()
+            return prices
+
+        # Any failure of the fetch is survivable while there are older prices to serve
+        except Exception as e:
+            if self.prices is None:
+                raise
+            print(e, file=sys.stderr)
+            metrics.increment('price cache', label='failed refresh')
+            self.retry_time = time.monotonic() + self.retry_delay
+            return self.prices
+        finally:
+            self.refresh_task = None
+
+    def invalidate(self):
+        """
+        Make the next get() refresh the prices, still serving the current ones while it does
+        """
+        self.fetched_time = min(self.fetched_time, time.monotonic() - self.ttl)
+        self.retry_time = 0
@@ -0,0 +1,92 @@
+"""
+Keep every user ordered by their credits so ranks and leader board pages can be read without sorting
+"""
+
+import bisect
+
+
+class RankIndex:
+    """
+    Sorted index of users by credits, highest first
+    """
+
+    def __init__(self, credits: dict = None):
+        """
+        Sorted index of users by credits, highest first
+
+        :param credits: Credits dictionary to build the index from
+        """
+        self.scores = {}
+        self.keys = []
+        if credits:
+            self.build(credits)
+
+    def build(self, credits: dict):
+        """
+        Rebuild the index from the credits dictionary
+
+        :param credits: Credits dictionary to build the index from
+        """
+        self.scores = {user: citizen.credits for user, citizen in credits.items()}
+        self.keys = sorted((-score, user) for user, score in self.scores.items())
+
+    def build_sorted(self, users: list, scores: list):
+        """
+        Rebuild the index from users that are already in order
+
+        :param users: IDs of every user, highest credits first and by id among equal credits
+        :param scores: Credits of each user
+        """
+        self.scores = dict(zip(users, scores))
+        self.keys = [(-score, user) for user, score in zip(users, scores)]
+
+    def update(self, user: int, score: int):
+        """
+        Move the user to the position of their new score
+
+        :param user: ID of the user
+        :param score: User's current credits
+        """
+        old_score = self.scores.get(user)
+        if old_score == score:
+            return
+        if old_score is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old_score, user))]
+        self.scores[user] = score
+        bisect.insort(self.keys, (-score, user))
+
+    def remove(self, user: int):
+        """
+        Remove the user from the index
+
+        :param user: ID of the user
+        """
+        old_score = self.scores.pop(user, None)
+        if old_score is not None:
+            del self.keys[bisect.bisect_left(self.keys, (-old_score, user))]
+
+    def rank(self, user: int) -> int:
+        """
+        Get the position of the user, starting at 0 for the highest credits
+
+        :param user: ID of the user
+        :return: Position of the user
+        """
+        return bisect.bisect_left(self.keys, (-self.scores[user], user))
+
+    def page(self, start: int, count: int) -> list:
+        """
+        Get a slice of the users in order
+
+        :param start: Position of the first user to return
+        :param count: Most users to return
+        :return: List of [position, id] pairs
+        """
+        start = max(start, 0)
+        return [[position, user] for position, (_, user) in enumerate(self.keys[start:start + count], start)]
+
+    def __len__(self) -> int:
+        """
+        Number of users in the index
+        """
+        return len(self.keys)
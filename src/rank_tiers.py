@@ -0,0 +1,99 @@
+"""
+Split the ranked citizens into classes, only checking the citizens that could have crossed into another class
+"""
+
+import os
+import math
+import bisect
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def load_class_roles() -> list:
+    """
+    Read the classes from CLASS_ROLES, such as Party Elite:0.01,Bourgeoisie:0.1,Proletariat:0.6,Gulag:1
+
+    :return: List of [role name, fraction of the citizens ranked at or above the class], or None if not set
+    """
+    class_roles = os.getenv('CLASS_ROLES')
+    if not class_roles:
+        return None
+    return sorted([[class_role.rsplit(':', 1)[0].strip(), float(class_role.rsplit(':', 1)[1])]
+                   for class_role in class_roles.split(',') if class_role], key=lambda class_role: class_role[1])
+
+
+class RankTiers:
+    """
+    Class of every citizen based on their position in the rank index
+    """
+
+    def __init__(self, class_roles: list):
+        """
+        Class of every citizen based on their position in the rank index
+
+        :param class_roles: List of [role name, fraction of the citizens ranked at or above the class], best first
+        """
+        self.names = [name for name, _ in class_roles]
+        self.fractions = [fraction for _, fraction in class_roles]
+        self.tiers = {}
+        self.boundaries = []
+        self.count = 0
+
+    def get_boundaries(self, count: int) -> list:
+        """
+        Get the first position after each class
+
+        :param count: Number of ranked citizens
+        :return: List of positions, one for each class
+        """
+        boundaries = [math.ceil(fraction * count) for fraction in self.fractions]
+        boundaries[-1] = count
+        return boundaries
+
+    def refresh(self, rank_index: object, users: tuple) -> list:
+        """
+        Update the classes after the given users changed
+
+        A citizen who did not change can only have moved as many places as there were changes, so only the citizens
+        that close to a class boundary need to be checked.
+
+        :param rank_index: RankIndex the users were updated in
+        :param users: IDs of the users whose credits changed
+        :return: List of the IDs of the users whose class changed
+        """
+        count = len(rank_index)
+        boundaries = self.get_boundaries(count)
+
+        # Check everyone the first time and after large changes
+        window = len(users) + abs(count - self.count)
+        if not self.tiers or window * len(boundaries) * 2 >= count:
+            positions = [[position, user] for position, (_, user) in enumerate(rank_index.keys)]
+        else:
+            candidates = {user for user in users if user in rank_index.scores}
+            for old_boundary, new_boundary in zip(self.boundaries, boundaries):
+                start = min(old_boundary, new_boundary) - window
+                end = max(old_boundary, new_boundary) + window
+                candidates.update(user for _, user in rank_index.page(start, end - start))
+            positions = [[rank_index.rank(user), user] for user in candidates]
+
+        changed = [user for user in users if user not in rank_index.scores and self.tiers.pop(user, None) is not None]
+        for position, user in positions:
+            tier = bisect.bisect_right(boundaries, position)
+            if self.tiers.get(user) != tier:
+                self.tiers[user] = tier
+                changed.append(user)
+        self.boundaries = boundaries
+        self.count = count
+        return changed
+
+    def role_name(self, user: int) -> str:
+        """
+        Get the name of the role for the user's class
+
+        :param user: ID of the user
+        :return: Name of the role, or None if the user is not ranked
+        """
+        tier = self.tiers.get(user)
+        return self.names[tier] if tier is not None else None
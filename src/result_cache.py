@@ -0,0 +1,72 @@
+"""
+Cache the rendered results of read-only commands so repeated views are not rendered again
+"""
+
+import os
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+from metrics import metrics
+
+load_dotenv()
+
+
+class ResultCache:
+    """
+    Least recently used cache of command results, bounded by the total size of the results
+
+    Keys should include the version of every piece of data the result was rendered from, so a change to the data
+    makes the old results unreachable and they age out on their own.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        """
+        Least recently used cache of command results, bounded by the total size of the results
+
+        :param max_bytes: Most bytes of results to keep, defaults to RESULT_CACHE_BYTES or 64 MB
+        """
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.getenv('RESULT_CACHE_BYTES', 64 * 1024 ** 2))
+        self.results = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        """
+        Get a cached result and mark it as recently used
+
+        :param key: Command, normalized arguments and data versions of the result
+        :return: Cached result, or None if it is not cached
+        """
+        if key not in self.results:
+            self.misses += 1
+            metrics.increment('result cache', label='miss')
+            return None
+        self.hits += 1
+        metrics.increment('result cache', label='hit')
+        self.results.move_to_end(key)
+        return self.results[key][0]
+
+    def put(self, key: tuple, result: object, size: int):
+        """
+        Cache a result, evicting the least recently used results until it fits
+
+        :param key: Command, normalized arguments and data versions of the result
+        :param result: Result to cache
+        :param size: Size of the result in bytes
+        """
+        if size > self.max_bytes:
+            return
+        if key in self.results:
+            self.total_bytes -= self.results.pop(key)[1]
+        self.results[key] = (result, size)
+        self.total_bytes += size
+        while self.total_bytes > self.max_bytes:
+            self.total_bytes -= self.results.popitem(last=False)[1][1]
+
+    def clear(self):
+        """
+        Drop every cached result
+        """
+        self.results.clear()
+        self.total_bytes = 0
@@ -0,0 +1,110 @@
+"""
+Give members the role of their class, batching the changes and spacing out the calls to stay under the rate limits
+"""
+
+import os
+import sys
+import asyncio
+
+from discord import utils
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class RoleUpdateQueue:
+    """
+    Apply the class changes of every server in batches
+    """
+
+    def __init__(self, update_interval: float = None, updates_per_second: float = None, retries: int = None):
+        """
+        Apply the class changes of every server in batches
+
+        :param update_interval: Seconds between batches, defaults to ROLE_UPDATE_INTERVAL or 10
+        :param updates_per_second: Most members to update each second, defaults to ROLE_UPDATES_PER_SECOND or 1
+        :param retries: Times to try a failed update again in a later batch, defaults to ROLE_UPDATE_RETRIES or 3
+        """
+        self.update_interval = update_interval if update_interval is not None \
+            else float(os.getenv('ROLE_UPDATE_INTERVAL', 10))
+        self.updates_per_second = updates_per_second if updates_per_second is not None \
+            else float(os.getenv('ROLE_UPDATES_PER_SECOND', 1))
+        self.retries = retries if retries is not None else int(os.getenv('ROLE_UPDATE_RETRIES', 3))
+        self.failures = {}
+        self.bot = None
+        self.guild_states = None
+        self.task = None
+
+    def start(self, bot: object, guild_states: object):
+        """
+        Start applying the class changes
+
+        :param bot: Discord bot to update the roles with
+        :param guild_states: GuildStates holding the class changes of every server
+        """
+        if self.task is None:
+            self.bot = bot
+            self.guild_states = guild_states
+            self.task = bot.loop.create_task(self.run())
+
+    async def run(self):
+        """
+        Apply every server's class changes since the last batch, once per update interval
+        """
+        while True:
+            await asyncio.sleep(self.update_interval)
+            for guild_state in list(self.guild_states.guilds.values()):
+                if not guild_state.tier_changes:
+                    continue
+
+                # Take the changes first, so changes made during the batch wait for the next one
+                users, guild_state.tier_changes = guild_state.tier_changes, set()
+                guild = self.bot.get_guild(guild_state.guild_id)
+                if guild is None:
+                    continue
+
+                # A server failing must not stop the updates of every server for good
+                try:
+                    await self.update_guild(guild, guild_state, users)
+                except Exception as e:
+                    print(f'Role updates failed on server {guild_state.guild_id}: {e!r}', file=sys.stderr)
+
+    async def update_guild(self, guild: object, guild_state: object, users: set):
+        """
+        Give each user the role of their current class, removing the roles of their other classes
+
+        :param guild: Discord server of the users
+        :param guild_state: GuildState of the server
+        :param users: IDs of the users whose class changed
+        """
+        class_roles = [utils.get(guild.roles, name=name) for name in guild_state.rank_tiers.names]
+        class_roles = {role.name: role for role in class_roles if role is not None}
+        if not class_roles:
+            return
+
+        for user in users:
+            member = guild.get_member(user)
+            if member is None:
+                continue
+
+            # Replace every role in a single call, and skip the call if the member already has the right role
+            wanted_role = class_roles.get(guild_state.rank_tiers.role_name(user))
+            roles = [role for role in member.roles[1:] if role not in class_roles.values()]
+            if wanted_role is not None:
+                roles.append(wanted_role)
+            if set(roles) == set(member.roles[1:]):
+                continue
+
+            # Any failure, from discord or the connection, is tried again in a later batch up to the retries
+            try:
+                await member.edit(roles=roles, reason='Social credit class changed')
+                self.failures.pop((guild_state.guild_id, user), None)
+            except Exception as e:
+                print(e, file=sys.stderr)
+                failures = self.failures.get((guild_state.guild_id, user), 0) + 1
+                if failures <= self.retries:
+                    self.failures[(guild_state.guild_id, user)] = failures
+                    guild_state.tier_changes.add(user)
+                else:
+                    self.failures.pop((guild_state.guild_id, user), None)
+            await asyncio.sleep(1 / self.updates_per_second)
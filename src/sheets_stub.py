@@ -0,0 +1,127 @@
+"""
+Local stand-in for the Google Sheets API serving a synthetic stock market sheet, so the stock market commands can be
+load tested without a key or a network
+"""
+
+import json
+import time
+import argparse
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TEAMS = ['TL', 'C9', 'TSM', '100', 'EG', 'FLY', 'CLG', 'DIG', 'GG', 'IMT']
+
+
+def create_sheet(weeks: int) -> bytes:
+    """
+    Create a prices sheet laid out like the real one, the starting price of each team followed by three days a week
+
+    :param weeks: Number of weeks of prices
+    :return: JSON response of the sheet
+    """
+    rows = [['Team', 'Record', 'Price']]
+    rows += [[team, '0-0', str(50 + team_cnt)] for team_cnt, team in enumerate(TEAMS)]
+    for week in range(weeks):
+        for day in range(3):
+            rows += [[team, '0-0', str(50 + team_cnt + (week * 3 + day) * (1 if team_cnt % 2 else -1))]
+                     for team_cnt, team in enumerate(TEAMS)]
+    return json.dumps({'range': 'Prices', 'majorDimension': 'ROWS', 'values': rows}).encode()
+
+
+class SheetsStub:
+    """
+    HTTP server in a background thread answering every request with the same sheet after a delay, optionally failing
+    every few requests to exercise the retries
+    """
+
+    def __init__(self, latency: float = 0, weeks: int = 4, fail_every: int = 0, retry_after: float = None):
+        """
+        HTTP server in a background thread answering every request with the same sheet after a delay, optionally
+        failing every few requests to exercise the retries
+
+        :param latency: Seconds to wait before answering, like the real API would
+        :param weeks: Number of weeks of prices in the sheet
+        :param fail_every: Answer every this many requests with a 503, or 0 to never fail
+        :param retry_after: Seconds the 503 answers ask to wait before retrying, or None to not say
+        """
+        self.latency = latency
+        self.fail_every = fail_every
+        self.retry_after = retry_after
+        self.sheet = create_sheet(weeks)
+        self.requests = 0
+        self.server = None
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        """
+        URL to use in place of https://sheets.googleapis.com
+        """
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self, port: int = 0) -> str:
+        """
+        Start serving
+
+        :param port: Port to serve on, or 0 for any free port
+        :return: Base URL of the server
+        """
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if stub.fail_every and stub.requests % stub.fail_every == 0:
+                    self.send_response(503)
+                    if stub.retry_after is not None:
+                        self.send_header('Retry-After', str(stub.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stub.sheet)))
+                self.end_headers()
+
+                # The client gave up waiting, which the timeout checks do on purpose
+                try:
+                    self.wfile.write(stub.sheet)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *_):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def close(self):
+        """
+        Stop the server
+        """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+if __name__ == '__main__':
+    # Serve the stand-in until stopped, point the bot at it with SHEETS_API_BASE_URL
+    parser = argparse.ArgumentParser(description='Serve a synthetic stock market sheet')
+    parser.add_argument('--port', type=int, default=8085, help='port to serve on')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds to wait before answering')
+    parser.add_argument('--fail-every', type=int, default=0, help='answer every this many requests with a 503')
+    arguments = parser.parse_args()
+    sheets_stub = SheetsStub(arguments.latency, fail_every=arguments.fail_every)
+    print(f'SHEETS_API_BASE_URL={sheets_stub.start(arguments.port)}')
+    try:
+        sheets_stub.thread.join()
+    except KeyboardInterrupt:
+        sheets_stub.close()
@@ -2,23 +2,44 @@
 This is the brain of the bot which parses input and manages the discord server
 """
 
+import time
+
+# Time the imports for the startup report
+import_start_time = time.perf_counter()
+
+import io
 import os
-import json
+import math
+import heapq
 import urllib
-import time
 import sys
-import lcs_stock_market
+import signal
+import asyncio
+import importlib
 
 from discord import File
 from discord import Activity
 from discord import ActivityType
-from discord.errors import HTTPException
+from discord import Intents
 from discord.ext import commands
 from dotenv import load_dotenv
-from text_to_image import CreateImage
+from result_cache import ResultCache
+from command_context import CommandContext
+from guild_state import GuildStates
+from role_updates import RoleUpdateQueue
+from outbound_queue import OutboundQueue
+from outbound_queue import MAX_MESSAGE_LENGTH
+from command_throttle import CommandThrottle
+from message_scheduler import MessageScheduler
+from command_router import CommandRouter
+from command_trace import create_trace_recorder
+from command_profiler import CommandProfiler
+from http_client import http_client
+from metrics import metrics
 
 # Load environment variables
 load_dotenv()
+import_time = time.perf_counter() - import_start_time
 
 
 class DiscordBot:
@@ -26,374 +47,636 @@ class DiscordBot:
     Social Credit Discord bot
     """
 
-    def __init__(self):
+    def __init__(self, start: bool = True):
         """
         Social Credit Discord bot
-        """
-        self.credits = {}
-        self.user = None
-        self.display_name = None
-        self.message = None
-        self.stock_market_bot_commands = None
-        self.post_credits = False
-        self.bot = commands.Bot(command_prefix='!')
-
-        # Grab the initial values
-        self.setup()
-
-        # Start listening to chat
-        self.start_bot()
-
-    def setup(self):
-        """
-        Setup the bot with the stored values
-        """
-
-        # If the credit_data.json file does not exist, create it
-        if not os.path.isfile('../extra_files/credit_data.json'):
-            with open('../extra_files/credit_data.json', 'w', encoding='utf-8') as credit_data_file:
-                credit_data_file.write('{\n}')
 
-        # If the file does exist, read it and save it's values
+        :param start: Boolean indicating if the bot should connect to discord, the benchmarks build it without
+        """
+        # Discord lists every server the bot is in as soon as it connects, before any message can arrive
+        self.guild_states = GuildStates(lambda: len(self.bot.guilds))
+        self.leader_board_page_size = 20
+        self.result_cache = ResultCache()
+        self.command_router = CommandRouter()
+        self.economy_tick_interval = float(os.getenv('ECONOMY_TICK_INTERVAL', 0))
+        self.economy_task = None
+        self.role_updates = RoleUpdateQueue()
+        self.outbound_queue = OutboundQueue()
+        self.command_throttle = CommandThrottle()
+        self.trace_recorder = create_trace_recorder()
+        self.command_profiler = CommandProfiler()
+        self.command_groups = {
+            'ussr': self.handle_ussr_message,
+            'stocks': self.handle_stock_market_message,
+            'birthday': self.handle_happy_birthday_message
+        }
+        self.ussr_commands = {
+            'add': self.add_credits,
+            'remove': self.remove_credits,
+            'set': self.set_credits,
+            'leaderboard': self.leader_board,
+            'top': self.top_citizens,
+            'around': self.citizens_around,
+            'history': self.credit_history,
+            'stats': self.post_stats,
+            'profile': self.profile_commands,
+            'help': self.help_message
+        }
+        self.startup_times = {'imports': import_time}
+        self.startup_start_time = time.perf_counter()
+        self.metrics_exporter = None
+        metrics.register_gauge('result cache bytes', lambda: self.result_cache.total_bytes)
+        metrics.register_gauge('loaded servers', lambda: len(self.guild_states.guilds))
+
+        # The previous run of the bot closes its event loop, so give every run a fresh one
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        intents = Intents.default()
+        intents.members = True
+
+        # Let discord.py split the servers across shards when the bot is in too many for a single connection
+        if os.getenv('AUTO_SHARD', 'false').lower() == 'true':
+            self.bot = commands.AutoShardedBot(command_prefix='!', intents=intents)
         else:
-            try:
-                with open('../extra_files/credit_data.json', 'r', encoding='utf-8') as credit_data_file:
-                    self.credits = json.load(credit_data_file)
+            self.bot = commands.Bot(command_prefix='!', intents=intents)
+        self.message_scheduler = MessageScheduler(self.bot)
 
-            # If the file is empty, create it an as empty dictionary
-            except json.decoder.JSONDecodeError:
-                with open('../extra_files/credit_data.json', 'w', encoding='utf-8') as credit_data_file:
-                    credit_data_file.write('{\n}')
-
-    def save_credits(self):
-        """
-        Save the current credits to the credit_data.json file
-        """
-
-        # Save the credits to the credit_data.json file
-        with open('../extra_files/credit_data.json', 'w', encoding='utf-8') as credit_data_file:
-            json.dump(self.credits, credit_data_file, indent=4)
+        # Start listening to chat
+        self.register_events()
+        if start:
+            self.start_bot()
 
-    async def add_credits(self, amount: str):
+    async def add_credits(self, ctx: CommandContext):
         """
         Add credits to the given user's account
 
-        :param amount: Amount of credits to add
+        :param ctx: Context of the command being handled
         """
-        amount = int(amount)
+        amount = ctx.command.amount
 
         # Add if the value is positive
         if amount >= 0:
-
-            # Processes for the author of the message if no mentions were included
-            if len(self.message.mentions) == 0 and len(self.message.role_mentions) == 0:
-                self.credits[self.user]['credits'] += amount
-                self.save_credits()
-                self.post_credits = True
-
-            # Do the action for everyone mentioned
-            else:
-
-                # Process each mention
-                for member in self.message.mentions:
-                    self.credits[member.name]['credits'] += amount
-                    self.save_credits()
-                    self.post_credits = False
-                    await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                    f'{self.credits[member.name]["credits"]} social credits')
-
-                # Process each role mention
-                for role in self.message.role_mentions:
-                    for member in role.members:
-                        self.credits[member.name]['credits'] += amount
-                        self.save_credits()
-                        self.post_credits = False
-                        await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                        f'{self.credits[member.name]["credits"]} social credits')
+            await self.change_credits(ctx, 'add', amount)
 
         # Don't add if negative
         else:
-            self.post_credits = False
-            await self.message.channel.send(f'Only user positive numbers, cheater.')
+            ctx.post_credits = False
+            ctx.send(f'Only user positive numbers, cheater.')
 
-    async def remove_credits(self, amount: str):
+    async def remove_credits(self, ctx: CommandContext):
         """
         Remove credits from the given user's account
 
-        :param amount: Amount of credits to remove
+        :param ctx: Context of the command being handled
         """
-        amount = int(amount)
+        amount = ctx.command.amount
 
-        # Add if the value is positive
+        # Remove if the value is positive
         if amount >= 0:
+            await self.change_credits(ctx, 'remove', amount)
 
-            # Processes for the author of the message if no mentions were included
-            if len(self.message.mentions) == 0 and len(self.message.role_mentions) == 0:
-                self.credits[self.user]['credits'] -= amount
-                self.save_credits()
-                self.post_credits = True
-
-            # Do the action for everyone mentioned
-            else:
-
-                # Process each mention
-                for member in self.message.mentions:
-                    self.credits[member.name]['credits'] -= amount
-                    self.save_credits()
-                    self.post_credits = False
-                    await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                    f'{self.credits[member.name]["credits"]} social credits')
-
-                # Process each role mention
-                for role in self.message.role_mentions:
-                    for member in role.members:
-                        self.credits[member.name]['credits'] -= amount
-                        self.save_credits()
-                        self.post_credits = False
-                        await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                        f'{self.credits[member.name]["credits"]} social credits')
-
-        # Don't add if negative
+        # Don't remove if negative
         else:
-            self.post_credits = False
-            await self.message.channel.send(f'Only user positive numbers, cheater.')
+            ctx.post_credits = False
+            ctx.send(f'Only user positive numbers, cheater.')
 
-    async def set_credits(self, amount: int):
+    async def set_credits(self, ctx: CommandContext):
         """
         Set the user's credits
 
-        :param amount: Amount of credits to set
+        :param ctx: Context of the command being handled
         """
-        amount = int(amount)
+        await self.change_credits(ctx, 'set', ctx.command.amount)
 
-        # Processes for the author of the message if no mentions were included
-        if len(self.message.mentions) == 0 and len(self.message.role_mentions) == 0:
-            self.credits[self.user]['credits'] = amount
-            self.save_credits()
-            self.post_credits = True
+    async def change_credits(self, ctx: CommandContext, operation: str, amount: int):
+        """
+        Apply the change to the author, or to everyone mentioned, then save and report it once
 
-        # Do the action for everyone mentioned
+        :param ctx: Context of the command being handled
+        :param operation: Either add, remove, or set
+        :param amount: Amount of credits to change by or set to
+        """
+        members = self.get_mentioned_members(ctx)
+
+        # Processes for the author of the message if no mentions were included
+        if len(members) == 0:
+            users = [ctx.user]
+            ctx.post_credits = True
         else:
+            users = [member.id for member in members]
+            ctx.post_credits = False
+
+        async with ctx.guild_state.user_locks.hold(*users):
+            for user in users:
+                if operation == 'add':
+                    ctx.credits[user].credits += amount
+                elif operation == 'remove':
+                    ctx.credits[user].credits -= amount
+                else:
+                    ctx.credits[user].credits = amount
+            ctx.guild_state.save_credits(*users)
+
+        if not ctx.post_credits:
+            await self.post_credit_summary(ctx, users, operation, amount)
+
+    def get_mentioned_members(self, ctx: CommandContext) -> list:
+        """
+        Get every member mentioned directly or through a role, counting each member only once
+
+        :param ctx: Context of the command being handled
+        :return: List of mentioned members
+        """
+        members = {member.id: member for member in ctx.message.mentions}
+        for role in ctx.message.role_mentions:
+            for member in role.members:
+                members.setdefault(member.id, member)
+
+        # Make sure everyone mentioned has an account, even if their join event was missed
+        for member in members.values():
+            self.sync_member(ctx.guild_state, member)
+        return list(members.values())
+
+    async def post_credit_summary(self, ctx: CommandContext, users: list, operation: str, amount: int):
+        """
+        Post the new credits of every changed user in a single message
+
+        :param ctx: Context of the command being handled
+        :param users: IDs of the users that were changed
+        :param operation: Either add, remove, or set
+        :param amount: Amount of credits the users were changed by or set to
+        """
+        summary = '\n'.join(f'{ctx.credits[user].display_name} now has {ctx.credits[user].credits} social credits'
+                             for user in users)
+        if len(summary) <= MAX_MESSAGE_LENGTH:
+            ctx.send(summary)
+            return
+
+        # Too many users to list in a message, so send the totals and a table of only the richest of them
+        changes = {'add': f'Added {amount} social credits to', 'remove': f'Removed {amount} social credits from',
+                   'set': f'Set the social credits to {amount} for'}
+        top_users = heapq.nlargest(self.leader_board_page_size, users, key=lambda user: ctx.credits[user].credits)
+        description = f'{changes[operation]} {len(users)} citizens, who now have ' \
+                      f'{sum(ctx.credits[user].credits for user in users)} social credits between them. ' \
+                      f'The richest {len(top_users)} of them:'
+        rows = [[ctx.credits[user].display_name, ctx.credits[user].credits] for user in top_users]
+        try:
+            # Render in the background so the other commands are not held up by the image
+            from text_to_image import CreateImage
+            image = await asyncio.get_event_loop().run_in_executor(
+                None, lambda: CreateImage(['Citizen', 'Social Credits'], rows).image)
+            ctx.send(description, file=File(io.BytesIO(image), filename='credit_summary.png'))
+        except ValueError:
+            ctx.send(description)
 
-            # Process each mention
-            for member in self.message.mentions:
-                self.credits[member.name]['credits'] = amount
-                self.save_credits()
-                self.post_credits = False
-                await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                f'{self.credits[member.name]["credits"]} social credits')
-
-            # Process each role mention
-            for role in self.message.role_mentions:
-                for member in role.members:
-                    self.credits[member.name]['credits'] = amount
-                    self.save_credits()
-                    self.post_credits = False
-                    await self.message.channel.send(f'{self.credits[member.name]["display name"]} now has '
-                                                    f'{self.credits[member.name]["credits"]} social credits')
-
-    async def post_user_credits(self):
+    async def post_user_credits(self, ctx: CommandContext):
         """
         Post the user's credits to discord
+
+        :param ctx: Context of the command being handled
         """
 
         # Display the users current credits
-        try:
-            await self.message.channel.send(f'{self.display_name} now has '
-                                            f'{self.credits[self.user]["credits"]} social credits.')
+        message = f'{ctx.display_name} now has {ctx.credits[ctx.user].credits} social credits.'
+        if len(message) <= MAX_MESSAGE_LENGTH:
+            ctx.send(message)
 
         # If the user has over the max discord character limit
-        except HTTPException:
+        else:
 
             # If they have positive credits
-            if self.credits[self.user]['credits'] > 0:
-                await self.message.channel.send(f'{self.display_name} is a social credit.')
+            if ctx.credits[ctx.user].credits > 0:
+                ctx.send(f'{ctx.display_name} is a social credit.')
 
             # If they have negative credits
-            elif self.credits[self.user]['credits'] < 0:
-                await self.message.channel.send(f'{self.display_name} couldn\'t dream of being worth enough to '
-                                                f'obtain a single social credit.')
+            elif ctx.credits[ctx.user].credits < 0:
+                ctx.send(f'{ctx.display_name} couldn\'t dream of being worth enough to '
+                         f'obtain a single social credit.')
 
-    async def leader_board(self):
+    async def leader_board(self, ctx: CommandContext):
         """
-        Post the leader board to discord
+        Post a page of the leader board to discord
+
+        :param ctx: Context of the command being handled
         """
+        rank_index = ctx.guild_state.rank_index
+        pages = max(math.ceil(len(rank_index) / self.leader_board_page_size), 1)
+        page = min(max(ctx.command.page, 1), pages)
+        positions = rank_index.page((page - 1) * self.leader_board_page_size, self.leader_board_page_size)
+        await self.post_leader_board(ctx, ('leaderboard', page), positions, f'Page {page} of {pages}')
 
-        try:
-            # Get the user's scores in order
-            score_order = sorted([self.credits[user]['credits'] for user in self.credits], reverse=True)
+    async def top_citizens(self, ctx: CommandContext):
+        """
+        Post the citizens with the most social credits to discord
+
+        :param ctx: Context of the command being handled
+        """
+        amount = ctx.command.amount
+        positions = ctx.guild_state.rank_index.page(0, amount)
+        await self.post_leader_board(ctx, ('top', amount), positions, f'Top {amount} citizens')
+
+    async def citizens_around(self, ctx: CommandContext):
+        """
+        Post the part of the leader board around the author, or around the mentioned or named citizen
+
+        :param ctx: Context of the command being handled
+        """
+        if len(ctx.message.mentions) > 0:
+            user = ctx.message.mentions[0].id
+            self.sync_member(ctx.guild_state, ctx.message.mentions[0])
+        elif len(ctx.command.arguments) > 0 and ctx.command.arguments[0] != 'me':
+            name = ' '.join(ctx.command.arguments)
+            user = ctx.guild_state.find_citizen(name)
+            if user is None:
+                ctx.send(f'Could not find the citizen: {name}')
+                return
+        else:
+            user = ctx.user
+
+        rank_index = ctx.guild_state.rank_index
+        rank = rank_index.rank(user)
+        positions = rank_index.page(rank - self.leader_board_page_size // 2, self.leader_board_page_size)
+        await self.post_leader_board(ctx, ('around', user), positions,
+                                     f'{ctx.credits[user].display_name} is ranked {rank + 1} of '
+                                     f'{len(rank_index)}')
+
+    async def post_leader_board(self, ctx: CommandContext, cache_key: tuple, positions: list, description: str):
+        """
+        Post the leader board image for the given positions to discord, rendering it only if it is not cached
 
-            # Create a array for each row
+        :param ctx: Context of the command being handled
+        :param cache_key: Command and arguments that produced the positions
+        :param positions: List of [position, id] pairs from the rank index
+        :param description: Message to post along with the image
+        """
+        cache_key = cache_key + (ctx.guild_state.guild_id, ctx.guild_state.credit_version)
+        image = self.result_cache.get(cache_key)
+        if image is None:
             rows = []
-            for amount in score_order:
-                for name in self.credits:
-                    if amount == self.credits[name]['credits'] \
-                            and self.credits[name]['display name'] not in [user[0] for user in rows]:
-                        rows.append([self.credits[name]['display name'], amount])
-                        break
-
-            # Set the value to a message if it is too big/small
-            for user_cnt, user in enumerate(rows):
-                if user[1] > 1000000000000000:
-                    rows[user_cnt][1] = 'Literally a social credit'
-                elif user[1] < -1000000000000000:
-                    rows[user_cnt][1] = 'Is mot worth your time reading their name'
-
-            # Create the image and send it to discord
-            CreateImage(['Citizen', 'Social Credits'], rows, '../extra_files/credit_leader_board.png')
-            await self.message.channel.send(file=File('../extra_files/credit_leader_board.png',
-                                                      filename='credit_leader_board.png'))
-            os.remove('../extra_files/credit_leader_board.png')
-        except ValueError:
-            await self.message.channel.send(f'Leader board too big to display')
+            for position, user in positions:
+                amount = ctx.credits[user].credits
 
-    def get_all_member_credit_information(self):
+                # Set the value to a message if it is too big/small
+                if amount > 1000000000000000:
+                    amount = 'Literally a social credit'
+                elif amount < -1000000000000000:
+                    amount = 'Is mot worth your time reading their name'
+                rows.append([position + 1, ctx.credits[user].display_name, amount])
+
+            try:
+                # Create the image
+                from text_to_image import CreateImage
+                image = CreateImage(['Rank', 'Citizen', 'Social Credits'], rows).image
+            except ValueError:
+                ctx.send(f'Leader board too big to display')
+                return
+            self.result_cache.put(cache_key, image, len(image))
+
+        # Send the image to discord
+        ctx.send(description, file=File(io.BytesIO(image), filename='credit_leader_board.png'))
+
+    async def credit_history(self, ctx: CommandContext):
         """
-        Add all of the members of the server to the credits list if they do not already exist
+        Post a chart of the author's credits over time, or of the mentioned citizen's
+
+        :param ctx: Context of the command being handled
         """
+        if len(ctx.message.mentions) > 0:
+            user = ctx.message.mentions[0].id
+            self.sync_member(ctx.guild_state, ctx.message.mentions[0])
+        else:
+            user = ctx.user
+        display_name = ctx.credits[user].display_name
+
+        cache_key = ('history', ctx.guild_state.guild_id, user, ctx.guild_state.credit_version)
+        image = self.result_cache.get(cache_key)
+        if image is None:
+            times, balances = ctx.guild_state.credit_history.points(user)
+            if not times:
+                ctx.send(f'{display_name} has no social credit history yet.')
+                return
+
+            # Carry the line on to now
+            times.append(int(time.time()))
+            balances.append(balances[-1])
+            from credit_history import render_history_graph
+            image = render_history_graph(display_name, times, balances)
+            self.result_cache.put(cache_key, image, len(image))
+
+        ctx.send(f'{display_name}\'s social credit history',
+                 file=File(io.BytesIO(image), filename='credit_history.png'))
+
+    async def post_stats(self, ctx: CommandContext):
+        """
+        Display how long each part of the bot has been taking, only for server administrators
+
+        :param ctx: Context of the command being handled
+        """
+        if not ctx.message.author.guild_permissions.administrator:
+            ctx.send(f'Only server administrators can see the Party\'s statistics {ctx.display_name}.')
+            return
+
+        # Cut the table short rather than going over the discord message length limit
+        summary = metrics.summary()[:MAX_MESSAGE_LENGTH - 6]
+        ctx.send(f'```{summary}```')
+
+    async def profile_commands(self, ctx: CommandContext):
+        """
+        Turn the command profiling on or off, or share the slowest profiles, only for server administrators
+
+        :param ctx: Context of the command being handled
+        """
+        if not ctx.message.author.guild_permissions.administrator:
+            ctx.send(f'Only server administrators can profile the Party {ctx.display_name}.')
+            return
+
+        option = ctx.command.arguments[0]
+        if option == 'on':
+            if ctx.command.amount is not None:
+                self.command_profiler.sample_rate = ctx.command.amount
+            self.command_profiler.enabled = True
+            ctx.send(f'Profiling {self.command_profiler.sample_rate:.0%} of the commands.')
+        elif option == 'off':
+            self.command_profiler.enabled = False
+            ctx.send('Stopped profiling the commands.')
+        elif option == 'dump':
+            profiles = self.command_profiler.dump().encode()
+            ctx.send(f'Slowest {len(self.command_profiler.profiles)} profiled commands',
+                     file=File(io.BytesIO(profiles), filename='command_profiles.txt'))
+        elif option == 'save':
+            profile_file = f'../extra_files/command_profiles_{int(time.time())}.txt'
+            self.command_profiler.save(profile_file)
+            ctx.send(f'Saved the slowest {len(self.command_profiler.profiles)} profiled commands to {profile_file}')
+        else:
+            self.command_profiler.clear()
+            ctx.send('Cleared the command profiles.')
 
-        # Loop through each member
-        for member in self.message.guild.members:
-            if member.name not in self.credits:
+    def get_all_member_credit_information(self, guild: object):
+        """
+        Add the server's members to its credits list if they do not already exist, used once the bot connects
 
-                # Extract all of the information needed
-                self.credits[member.name] = {'credits': 0,
-                                             'id': member.id,
-                                             'mention': member.mention,
-                                             'display name': member.display_name}
+        :param guild: Discord server to add the members of
+        """
+        with metrics.timer('load server members'):
+            guild_state = self.guild_states.get(guild.id)
+            changed = [member.id for member in guild.members if self.update_member(guild_state, member)]
 
-            # Updated display names
-            else:
-                self.credits[member.name]['display name'] = member.display_name
+            # Save only the users that changed
+            guild_state.save_credits(*changed)
 
-        # Save the dictionary
-        self.save_credits()
+    @staticmethod
+    def update_member(guild_state: object, member: object) -> bool:
+        """
+        Add the member to the credits list if they do not already exist, otherwise update their names
 
-    async def help_message(self):
+        :param guild_state: GuildState of the member's server
+        :param member: Discord member to add or update
+        :return: Boolean indicating if anything about the member changed
         """
-        Display the help message for the bot
+        citizen = guild_state.credits.get(member.id)
+        if citizen is None:
+            guild_state.add_citizen(member)
+            return True
+
+        # Updated names
+        changed = False
+        if citizen.name != member.name:
+            guild_state.rename_citizen(citizen, member.name)
+            changed = True
+        if citizen.display_name != member.display_name:
+            citizen.display_name = member.display_name
+            changed = True
+        return changed
+
+    def sync_member(self, guild_state: object, member: object):
+        """
+        Add or update a single member and save them if anything changed
+
+        :param guild_state: GuildState of the member's server
+        :param member: Discord member to add or update
         """
-        await self.message.channel.send('Social Credit commands:```'
-                                        'Whenever I have multiple commands like ussr/USSR that means any of the listed '
-                                        'ones work. Anything in square brackets [] is optional, curly braces {} are '
-                                        'required but have an obvious substitute for the word. All commands start '
-                                        'with !'
-                                        ''
-                                        '\n\n!ussr/USSR'
-                                        '\n\t-\tBasic commands to use the bot. This will display your current balance.'
-                                        '\n\t-\tAll of the following commands work with all of these options, but I '
-                                        'will just show using USSR as it is redundant to list all of them.'
-                                        ''
-                                        '\n\n!USSR add {amount} [@Citizen]'
-                                        '\n\t-\tAdd social credits to your account. Replace {amount} with the value you'
-                                        ' want to add.'
-                                        '\n\t-\tIf you ping a user or group at the end of the message it will '
-                                        'add credits to their account instead.'
-                                        '\n\t-\te.g. !USSR add 12345'
-                                        '\n\t-\te.g. !USSR add 54321 @Debonairesnake6'
-                                        '\n\t-\te.g. !USSR add 123 @TheSquad'
-                                        ''
-                                        '\n\n!USSR remove {amount} [@Citizen]'
-                                        '\n\t-\tRemove social credits from your account. Replace {amount} with the '
-                                        'value you want to remove.'
-                                        '\n\t-\tIf you ping a user or group at the end of the '
-                                        'message it will remove credits from their account instead.'
-                                        '\n\t-\te.g. !USSR remove 12345'
-                                        '\n\t-\te.g. !USSR remove 54321 @Debonairesnake6'
-                                        '\n\t-\te.g. !USSR remove 123 @TheSquad'
-                                        ''
-                                        '\n\n!USSR set {amount} [@Citizen]'
-                                        '\n\t-\tSet the amount of social credits in your account. Replace {amount} '
-                                        'with the value you want to set it to.'
-                                        '\n\t-\tIf you ping a user or group at the end '
-                                        'of the message it will set their credits to that amount instead.'
-                                        '\n\t-\te.g. !USSR set 12345'
-                                        '\n\t-\te.g. !USSR set 54321 @Debonairesnake6'
-                                        '\n\t-\te.g. !USSR set 123 @TheSquad'
-                                        ''
-                                        '\n\n!USSR leaderboard'
-                                        '\n\t-\tDisplay the leaderboard for each citizen\'s bank account.'
-                                        '\n\t-\te.g. !USSR leaderboard'
-                                        ''
-                                        '\n\n!USSR help'
-                                        '\n\t-\tShow this help message.```')
-
-    async def unknown_command(self):
-        """
-        Tell the user the given command is unknown
-        """
-        await self.message.channel.send(f'Unknown command: {self.message.content.split()[1]}. Use the following command'
-                                        f' for help.\n!ussr help')
-
-    async def handle_ussr_message(self):
+        if self.update_member(guild_state, member):
+            guild_state.save_credits(member.id)
+
+    @staticmethod
+    def remove_member(guild_state: object, member: object):
+        """
+        Remove a member who left the server, unless they still have credits or stocks to come back to
+
+        :param guild_state: GuildState of the member's server
+        :param member: Discord member who left
+        """
+        citizen = guild_state.credits.get(member.id)
+        if citizen is not None and citizen.credits == 0 and citizen.stock_market is None:
+            guild_state.remove_citizen(member.id)
+            guild_state.save_credits(member.id)
+
+    async def help_message(self, ctx: CommandContext):
+        """
+        Display the help message for the bot
+
+        :param ctx: Context of the command being handled
+        """
+        ctx.send('Social Credit commands:```'
+                 'Whenever I have multiple commands like ussr/USSR that means any of the listed '
+                 'ones work. Anything in square brackets [] is optional, curly braces {} are '
+                 'required but have an obvious substitute for the word. All commands start '
+                 'with !'
+                 ''
+                 '\n\n!ussr/USSR'
+                 '\n\t-\tBasic commands to use the bot. This will display your current balance.'
+                 '\n\t-\tAll of the following commands work with all of these options, but I '
+                 'will just show using USSR as it is redundant to list all of them.'
+                 ''
+                 '\n\n!USSR add {amount} [@Citizen]'
+                 '\n\t-\tAdd social credits to your account. Replace {amount} with the value you'
+                 ' want to add.'
+                 '\n\t-\tIf you ping a user or group at the end of the message it will '
+                 'add credits to their account instead.'
+                 '\n\t-\te.g. !USSR add 12345'
+                 '\n\t-\te.g. !USSR add 54321 @Debonairesnake6'
+                 '\n\t-\te.g. !USSR add 123 @TheSquad'
+                 ''
+                 '\n\n!USSR remove {amount} [@Citizen]'
+                 '\n\t-\tRemove social credits from your account. Replace {amount} with the '
+                 'value you want to remove.'
+                 '\n\t-\tIf you ping a user or group at the end of the '
+                 'message it will remove credits from their account instead.'
+                 '\n\t-\te.g. !USSR remove 12345'
+                 '\n\t-\te.g. !USSR remove 54321 @Debonairesnake6'
+                 '\n\t-\te.g. !USSR remove 123 @TheSquad'
+                 ''
+                 '\n\n!USSR set {amount} [@Citizen]'
+                 '\n\t-\tSet the amount of social credits in your account. Replace {amount} '
+                 'with the value you want to set it to.'
+                 '\n\t-\tIf you ping a user or group at the end '
+                 'of the message it will set their credits to that amount instead.'
+                 '\n\t-\te.g. !USSR set 12345'
+                 '\n\t-\te.g. !USSR set 54321 @Debonairesnake6'
+                 '\n\t-\te.g. !USSR set 123 @TheSquad```')
+
+        # The rest goes in a second message to stay under the discord message length limit
+        ctx.send('```!USSR leaderboard [page]'
+                 '\n\t-\tDisplay the leaderboard for each citizen\'s bank account, one page '
+                 'at a time.'
+                 '\n\t-\te.g. !USSR leaderboard'
+                 '\n\t-\te.g. !USSR leaderboard 3'
+                 ''
+                 '\n\n!USSR top [amount]'
+                 '\n\t-\tDisplay the citizens with the most social credits.'
+                 '\n\t-\te.g. !USSR top 5'
+                 ''
+                 '\n\n!USSR around me/[@Citizen]/[name]'
+                 '\n\t-\tDisplay the part of the leaderboard around you or the citizen you '
+                 'ping or name.'
+                 '\n\t-\te.g. !USSR around me'
+                 '\n\t-\te.g. !USSR around @Debonairesnake6'
+                 '\n\t-\te.g. !USSR around Debonairesnake6'
+                 ''
+                 '\n\n!USSR history [@Citizen]'
+                 '\n\t-\tDisplay a chart of your social credits over time, or of the citizen '
+                 'you ping.'
+                 '\n\t-\te.g. !USSR history'
+                 '\n\t-\te.g. !USSR history @Debonairesnake6'
+                 ''
+                 '\n\n!USSR stats'
+                 '\n\t-\tDisplay how long the bot has been taking to respond. Server '
+                 'administrators only.'
+                 ''
+                 '\n\n!USSR profile on [fraction]/off/dump/save/clear'
+                 '\n\t-\tProfile a fraction of the commands, then post or save the slowest. '
+                 'Server administrators only.'
+                 '\n\t-\te.g. !USSR profile on 0.25'
+                 ''
+                 '\n\n!USSR help'
+                 '\n\t-\tShow this help message.```')
+
+    async def handle_ussr_message(self, ctx: CommandContext):
         """
         Process the incoming USSR discord message
+
+        :param ctx: Context of the command being handled
         """
-        # Check if any arguments were given
-        valid = ['!USSR', '!ussr']
-        if self.message.content not in valid:
-
-            # Process the command based on the arguments
-            command = self.message.content.split(' ')[1]
-            command_list = {
-                'add': self.add_credits,
-                'remove': self.remove_credits,
-                'set': self.set_credits,
-                'leaderboard': self.leader_board,
-                'help': self.help_message
-            }
-            if len(self.message.content.split(' ')) == 2:
-                await command_list.get(command, self.unknown_command)()
-            else:
-                # noinspection PyArgumentList
-                await command_list.get(command, self.unknown_command)(self.message.content.split(' ')[2])
+        # Tell the user if the command or its arguments were not valid
+        if ctx.command.error:
+            ctx.send(ctx.command.error)
+
+        # Process the command based on the arguments
+        elif ctx.command.action is not None:
+            await self.ussr_commands[ctx.command.action](ctx)
 
             # Toggle if the user's credits should be posted
-            if self.post_credits is True:
-                await self.post_user_credits()
+            if ctx.post_credits is True:
+                await self.post_user_credits(ctx)
 
         # If no arguments were given
         else:
-            await self.post_user_credits()
+            await self.post_user_credits(ctx)
 
-    async def handle_stock_market_message(self):
+    async def handle_stock_market_message(self, ctx: CommandContext):
         """
         Handle the incoming stock marker message
+
+        :param ctx: Context of the command being handled
         """
-        self.stock_market_bot_commands = lcs_stock_market.StockMarketBotCommands(self)
-        self.stock_market_bot_commands.setup()
-        self.stock_market_bot_commands.parse_discord_message()
+        import lcs_stock_market
+        stock_market_bot_commands = lcs_stock_market.StockMarketBotCommands(self, ctx)
+
+        # Fetch the prices before taking the author's lock, so changes to their credits never wait on Google Sheets
+        await stock_market_bot_commands.setup()
+        async with ctx.guild_state.user_locks.hold(ctx.user):
+            stock_market_bot_commands.open_account()
+
+        # Reuse the result of a read-only command if nothing it depends on has changed
+        cache_key = stock_market_bot_commands.get_cache_key()
+        result = self.result_cache.get(cache_key) if cache_key else None
+        if result is None:
+            if stock_market_bot_commands.reads_written_credits():
+                await ctx.guild_state.credit_writer.flush()
+
+            # Hold the author's lock so their account and stocks cannot change between reading and updating them
+            async with ctx.guild_state.user_locks.hold(ctx.user):
+                stock_market_bot_commands.parse_discord_message()
+            result = self.collect_stock_market_result(stock_market_bot_commands)
+            if cache_key:
+                self.result_cache.put(cache_key, result, sum(len(image) for _, image in result['images']))
 
         # Post any given status messages
-        if self.stock_market_bot_commands.status_message:
-            await self.message.channel.send(self.stock_market_bot_commands.status_message)
-
-        # Post and remove any created images
-        images = ['stock_market_line_graph.png', 'stock_market_leaderboard.png', 'stock_market_player_status.png',
-                  'stock_market_table.png']
-        for image_file in images:
-            image_file = f'../extra_files/{image_file}'
-            if os.path.isfile(image_file):
-                await self.message.channel.send(self.stock_market_bot_commands.image_description,
-                                                file=File(image_file, filename=image_file))
-                os.remove(image_file)
+        if result['status message']:
+            ctx.send(result['status message'])
+
+        # Post any created images
+        for file_name, image in result['images']:
+            ctx.send(result['image description'], file=File(io.BytesIO(image), filename=file_name))
 
         # Post if any teams were not found
         not_found = ''
-        for team in self.stock_market_bot_commands.stock_market.not_found_teams:
+        for team in result['not found teams']:
             not_found += f'{team}, '
         if not_found != '':
-            await self.message.channel.send(f'Could not find the teams: {not_found[:-2]}')
+            ctx.send(f'Could not find the teams: {not_found[:-2]}')
+
+    @staticmethod
+    def collect_stock_market_result(stock_market_bot_commands: object) -> dict:
+        """
+        Collect everything the stock market command created so it can be posted and cached
+
+        :param stock_market_bot_commands: Stock market commands that handled the message
+        :return: Dictionary of the status message, images, image description and teams that were not found
+        """
+        return {'status message': stock_market_bot_commands.status_message,
+                'images': stock_market_bot_commands.images,
+                'image description': stock_market_bot_commands.image_description,
+                'not found teams': stock_market_bot_commands.stock_market.not_found_teams}
 
-    async def handle_happy_birthday_message(self):
+    async def handle_happy_birthday_message(self, ctx: CommandContext):
         """
         Handle the incoming happy birthday message
+
+        :param ctx: Context of the command being handled
         """
 
+        if len(ctx.command.arguments) == 0:
+            ctx.send('Who\'s birthday is it?\ne.g. !birthday @Debonairesnake6')
+            return
+
         birthday_message = 'Happy Birthday'
-        for letter in birthday_message:
-            await self.message.channel.send(f'{letter} {self.message.content.split()[1]}')
-            time.sleep(1)
+        await self.message_scheduler.schedule(ctx.message.channel.id,
+                                              [f'{letter} {ctx.command.arguments[0]}' for letter in birthday_message],
+                                              interval=1)
+
+    async def run_economy(self):
+        """
+        Run an economy tick on every server each ECONOMY_TICK_INTERVAL seconds
+        """
+        from economy import Economy
+        economy = Economy()
+        while True:
+            await asyncio.sleep(self.economy_tick_interval)
+            for guild in self.bot.guilds:
+
+                # A server the tick fails on must not stop the economy of every server for good
+                try:
+                    economy.tick(self.guild_states.get(guild.id), economy.new_citizens(guild.members))
+                except Exception as e:
+                    print(f'Economy tick failed on server {guild.id}: {e!r}', file=sys.stderr)
+
+    def warm_up(self):
+        """
+        Import the stock market and image modules and load the table font, run in the background once the bot is
+        ready so the first command using them does not pay for it
+        """
+        warm_up_start_time = time.perf_counter()
+        for module in ['lcs_stock_market', 'text_to_image']:
+            importlib.import_module(module)
+        importlib.import_module('text_to_image').load_font(20)
+        self.startup_times['warm up (background)'] = time.perf_counter() - warm_up_start_time
+        self.report_startup_times()
+
+    def report_startup_times(self):
+        """
+        Print how long each part of starting the bot took
+        """
+        times = ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.startup_times.items())
+        print(f'Startup times: {times}')
 
     @staticmethod
     async def message_user(user: object, message: str):
@@ -407,18 +690,45 @@ class DiscordBot:
 
     def start_bot(self):
         """
-        Start the bot
+        Start the bot, then once it stops close the shared HTTP connections and write everything left
+
+        This does what the bot's run() does, but run() closes the event loop without closing the bot when stopped by a
+        signal, which leaves no loop to close the HTTP connections on.
         """
-        valid_commands = {
-            'USSR': self.handle_ussr_message,
-            'ussr': self.handle_ussr_message,
-            'stock': self.handle_stock_market_message,
-            'stocks': self.handle_stock_market_message,
-            'stonk': self.handle_stock_market_message,
-            'stonks': self.handle_stock_market_message,
-            'birthday': self.handle_happy_birthday_message
-        }
+        loop = self.bot.loop
 
+        # Stop by closing the bot, so its start() returns and the clean up below still has a running loop
+        try:
+            loop.add_signal_handler(signal.SIGINT, lambda: loop.create_task(self.bot.close()))
+            loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(self.bot.close()))
+        except NotImplementedError:
+            pass
+
+        try:
+            loop.run_until_complete(self.bot.start(os.getenv('DISCORD_TOKEN')))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            try:
+                if not self.bot.is_closed():
+                    loop.run_until_complete(self.bot.close())
+                loop.run_until_complete(http_client.close())
+            finally:
+                self.guild_states.close()
+                if self.trace_recorder is not None:
+                    self.trace_recorder.close()
+
+                # Cancel whatever is still running, such as the outbound queue and the economy, before closing the loop
+                tasks = asyncio.all_tasks(loop)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.close()
+
+    def register_events(self):
+        """
+        Register the handlers of the discord events, which the trace replay also calls directly
+        """
         @self.bot.event
         async def on_message(message: object):
             """
@@ -426,14 +736,41 @@ class DiscordBot:
 
             :param message: Context of the message
             """
-            if message.content != '' \
-                    and message.content.split()[0][1:] in valid_commands \
-                    and message.content[0] == '!':
-                self.user = message.author.name
-                self.display_name = message.author.display_name
-                self.message = message
-                self.get_all_member_credit_information()
-                await valid_commands[message.content.split()[0][1:]]()
+            command = self.command_router.parse(message.content)
+
+            # Credits belong to a server, so commands are only handled in server channels
+            if command is None or message.guild is None:
+                return
+
+            # Record every command, even those turned away, to replay the same load later
+            if self.trace_recorder is not None:
+                self.trace_recorder.record(message, time.time())
+
+            # Turn away users and channels sending too many commands before doing any work for them
+            if not self.command_throttle.allow(message, command):
+                metrics.increment('throttled commands')
+                if self.command_throttle.should_warn(message.author.id):
+                    self.outbound_queue.send(message.channel, f'Slow down {message.author.display_name}, the '
+                                                              f'Party is processing your previous requests.')
+                return
+
+            # Let an identical command already being handled in the channel answer this one too
+            shared_key = self.command_throttle.shared_key(message, command)
+            if shared_key in self.command_throttle.in_flight:
+                metrics.increment('merged commands')
+                return
+            if shared_key is not None:
+                self.command_throttle.in_flight.add(shared_key)
+
+            try:
+                guild_state = self.guild_states.get(message.guild.id)
+                self.sync_member(guild_state, message.author)
+                command_name = f'{command.group} {command.action or ""}'.strip()
+                with metrics.timer('command', command_name), self.command_profiler.profile(command_name):
+                    await self.command_groups[command.group](CommandContext(message, command, guild_state,
+                                                                            self.outbound_queue))
+            finally:
+                self.command_throttle.in_flight.discard(shared_key)
 
         @self.bot.event
         async def on_ready():
@@ -443,11 +780,75 @@ class DiscordBot:
             if os.name == 'nt':
                 print('Ready')
 
+            # Only the first connection counts towards the startup time
+            first_ready = 'connect' not in self.startup_times
+            if first_ready:
+                self.startup_times['connect'] = time.perf_counter() - self.startup_start_time
+
+            self.guild_states.start(self.bot.loop)
+            self.message_scheduler.start()
+
+            # Keep the class roles current if classes are turned on
+            if self.guild_states.class_roles:
+                self.role_updates.start(self.bot, self.guild_states)
+
+            # Give out income and collect taxes if the economy is turned on
+            if self.economy_tick_interval > 0 and self.economy_task is None:
+                self.economy_task = self.bot.loop.create_task(self.run_economy())
+
+            # Serve the metrics for Prometheus if a port is given
+            metrics_port = os.getenv('METRICS_PORT')
+            if metrics_port and self.metrics_exporter is None:
+                self.metrics_exporter = self.bot.loop.create_task(metrics.start_exporter(int(metrics_port)))
+
+            # Bring every server's members up to date once, events keep them current from here on
+            load_start_time = time.perf_counter()
+            for guild in self.bot.guilds:
+                self.get_all_member_credit_information(guild)
+            if first_ready:
+                self.startup_times['load servers'] = time.perf_counter() - load_start_time
+                self.bot.loop.run_in_executor(None, self.warm_up)
+
             await self.bot.change_presence(activity=Activity(type=ActivityType.playing, name='!ussr help | '
                                                                                              '!stocks help'))
 
-        # Run the bot
-        self.bot.run(os.getenv('DISCORD_TOKEN'))
+        @self.bot.event
+        async def on_member_join(member: object):
+            """
+            Open an account for the new member
+
+            :param member: Member who joined
+            """
+            self.sync_member(self.guild_states.get(member.guild.id), member)
+
+        @self.bot.event
+        async def on_member_update(before: object, after: object):
+            """
+            Keep the member's display name current
+
+            :param before: Member before the update
+            :param after: Member after the update
+            """
+            if before.display_name != after.display_name:
+                self.sync_member(self.guild_states.get(after.guild.id), after)
+
+        @self.bot.event
+        async def on_member_remove(member: object):
+            """
+            Close the account of the member who left
+
+            :param member: Member who left
+            """
+            self.remove_member(self.guild_states.get(member.guild.id), member)
+
+        @self.bot.event
+        async def on_guild_join(guild: object):
+            """
+            Open an account for every member of the new server
+
+            :param guild: Server the bot joined
+            """
+            self.get_all_member_credit_information(guild)
 
 
 if __name__ == '__main__':
@@ -458,17 +859,12 @@ if __name__ == '__main__':
         try:
 
             # ToDo list:
-            #   -   class roles based on credits
             #   -   insult based on class
             #   -   periodically insult members of the lowest rank
-            #   -   gain/lose permissions based on rank
             #   -   delete messages from a user from x minutes ago
             #   -   remove permissions for period of time
             #   -   Announce birthdays/other events/holidays
-            #   -   Users forced to distribute wealth to new citizens
-            #   -   tax system
             #   -   Leader board colouring
-            #   -   Gain credits over time
             #   -   Bank
             #   -   LCS betting
             #   -   Buy abilities to mute others
@@ -2,22 +2,37 @@
 This file will create an image from the input as a table
 """
 
+import io
 import prettytable
+
+from functools import lru_cache
 from PIL import Image, ImageDraw, ImageFont
+from metrics import metrics
+
+
+@lru_cache(maxsize=None)
+def load_font(size: int) -> ImageFont.FreeTypeFont:
+    """
+    Load the table font once per size instead of for every image
+
+    :param size: Size of the font
+    :return: Courier font of the given size
+    """
+    return ImageFont.truetype('../extra_files/cour.ttf', size)
 
 
 class CreateImage:
     """
     Create an image from the given input
     """
-    def __init__(self, titles: list, rows: list, file_name: str, colour: list = False, convert_columns: bool = False,
-                 title_colours: list = False):
+    def __init__(self, titles: list, rows: list, file_name: str = None, colour: list = False,
+                 convert_columns: bool = False, title_colours: list = False):
         """
         Create an image from the given input
 
         :param titles: List of names to use for the titles of each column
         :param rows: List of rows to add to the table
-        :param file_name: Name to save the file as
+        :param file_name: Name to save the file as, if not given the PNG is kept in memory as image
         :param colour: Dual array of colours to colour each word in the table
         :param convert_columns: Convert the riven rows from columns into rows
         :param title_colours: Array of colours to paint the titles with
@@ -27,17 +42,20 @@ class CreateImage:
         self.table = None
         self.table_to_image = None
         self.file_name = file_name
+        self.image = None
         self.colour = colour
         self.convert_columns = convert_columns
         self.title_colours = title_colours
 
-        # Setup and add rows to the table
-        self.setup()
-        self.add_rows()
+        with metrics.timer('create image'):
 
-        # Create the image from the table
-        self.turn_into_image()
-        self.save_image()
+            # Setup and add rows to the table
+            self.setup()
+            self.add_rows()
+
+            # Create the image from the table
+            self.turn_into_image()
+            self.save_image()
 
     def setup(self):
         """
@@ -69,9 +87,14 @@ class CreateImage:
 
     def save_image(self):
         """
-        Save the image as the given file name
+        Save the image as the given file name, or as PNG bytes in memory if there is no file name
         """
-        self.table_to_image.img.save(self.file_name)
+        if self.file_name:
+            self.table_to_image.img.save(self.file_name)
+        else:
+            image = io.BytesIO()
+            self.table_to_image.img.save(image, format='PNG')
+            self.image = image.getvalue()
 
     def convert_columns_to_rows(self, columns: list):
         """
@@ -167,7 +190,7 @@ class TableToImage:
         self.img = Image.new('RGB', ((columns * 12) + 24, rows * 21 + 48), color=(54, 57, 63))
 
         # Initialize font and drawing object
-        self.font = ImageFont.truetype('../extra_files/cour.ttf', 20)
+        self.font = load_font(20)
         self.draw = ImageDraw.Draw(self.img)
 
         # Draw the table without markings